@@ -0,0 +1,149 @@
+import math
+import os
+
+import faiss
+import numpy as np
+
+# Vector index backends. Flat is exact and fine for a handful of PDFs; the
+# approximate ones trade a little recall for much faster search (HNSW) or much
+# smaller memory (IVF-PQ) on libraries with tens of thousands of pages.
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+INDEX_TYPE = os.environ.get("RAG_INDEX_TYPE", "flat").lower()
+
+# Embeddings are L2-normalized at encode time, so inner product is cosine similarity
+METRIC = faiss.METRIC_INNER_PRODUCT
+
+# How Flat, HNSW and IVF-Flat keep the vectors: float16 halves and int8 quarters
+# the memory of float32 at a small cost in score precision. IVF-PQ is always compressed.
+VECTOR_STORAGES = {
+    "float32": None,
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+VECTOR_STORAGE = os.environ.get("RAG_VECTOR_STORAGE", "float32").lower()
+
+# Build-time parameters: changing any of them changes the persisted index
+HNSW_M = int(os.environ.get("RAG_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("RAG_HNSW_EF_CONSTRUCTION", "200"))
+IVF_NLIST = int(os.environ.get("RAG_IVF_NLIST", "0"))        # 0 = 4 * sqrt(vectors)
+PQ_M = int(os.environ.get("RAG_PQ_M", "16"))                  # sub-quantizers, must divide the dimension
+PQ_NBITS = int(os.environ.get("RAG_PQ_NBITS", "8"))
+
+# Search-time parameters: applied whenever an index is built or loaded
+HNSW_EF_SEARCH = int(os.environ.get("RAG_HNSW_EF_SEARCH", "64"))
+IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "8"))
+
+# faiss wants roughly this many training points per k-means centroid
+MIN_POINTS_PER_CENTROID = 39
+
+
+def index_signature(index_type=INDEX_TYPE, storage=VECTOR_STORAGE):
+    """Identifies the build parameters, so persisted indexes of another kind are not reused."""
+    if index_type == "hnsw":
+        return f"hnsw:ip:{storage}:m={HNSW_M}:efc={HNSW_EF_CONSTRUCTION}"
+    if index_type == "ivf_flat":
+        return f"ivf_flat:ip:{storage}:nlist={IVF_NLIST}"
+    if index_type == "ivf_pq":
+        return f"ivf_pq:ip:nlist={IVF_NLIST}:m={PQ_M}:nbits={PQ_NBITS}"
+    return f"flat:ip:{storage}"
+
+
+def storage_dtype(storage=VECTOR_STORAGE):
+    """numpy dtype for embedding matrices kept next to the index."""
+    return "float32" if storage == "float32" else "float16"
+
+
+def _nlist(count, nlist=IVF_NLIST):
+    if nlist <= 0:
+        nlist = int(4 * math.sqrt(count))
+    return max(1, min(nlist, count // MIN_POINTS_PER_CENTROID))
+
+
+def create_ann_index(embeddings, index_type=INDEX_TYPE, storage=VECTOR_STORAGE):
+    """
+    Build and, where needed, train an inner-product index of the given type over
+    normalized embeddings.
+
+    IVF and PQ need enough vectors to train their quantizers; below that the
+    corpus is small enough that an exact Flat index is the better choice anyway.
+
+    Args:
+        embeddings: matrix of unit-length vectors, one row per chunk
+        index_type: one of INDEX_TYPES
+        storage: one of VECTOR_STORAGES
+
+    Returns:
+        faiss index with search parameters applied
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"Unknown vector storage {storage!r}, expected one of {tuple(VECTOR_STORAGES)}")
+
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    count, dimension = embeddings.shape
+
+    if index_type == "ivf_pq" and count < MIN_POINTS_PER_CENTROID * (1 << PQ_NBITS):
+        print(f"Only {count} vectors, too few to train IVF-PQ; using IVF-Flat")
+        index_type = "ivf_flat"
+
+    if index_type == "ivf_flat" and count < MIN_POINTS_PER_CENTROID:
+        print(f"Only {count} vectors, too few to train IVF; using Flat")
+        index_type = "flat"
+
+    qtype = VECTOR_STORAGES[storage]
+
+    if index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dimension, HNSW_M, METRIC)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, qtype, HNSW_M, METRIC)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type == "ivf_flat":
+        quantizer = faiss.IndexFlatIP(dimension)
+        if qtype is None:
+            index = faiss.IndexIVFFlat(quantizer, dimension, _nlist(count), METRIC)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, _nlist(count), qtype, METRIC)
+    elif index_type == "ivf_pq":
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, _nlist(count), PQ_M, PQ_NBITS, METRIC)
+    else:
+        if qtype is None:
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = faiss.IndexScalarQuantizer(dimension, qtype, METRIC)
+
+    if not index.is_trained:
+        index.train(embeddings)
+
+    index.add(embeddings)
+
+    return apply_search_params(index)
+
+
+def apply_search_params(index, nprobe=IVF_NPROBE, ef_search=HNSW_EF_SEARCH):
+    """Set nprobe / efSearch on IVF and HNSW indexes; other types are returned unchanged."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+    return index
+
+
+def is_ivf_index(index):
+    """
+    IVF indexes opened from disk keep their inverted lists memory-mapped, which
+    faiss.clone_index cannot copy; they are rebuilt instead of extended.
+    """
+    return faiss.try_extract_index_ivf(index) is not None
+
+
+def index_memory_bytes(index):
+    """Serialized size of the index, a close proxy for its resident memory."""
+    return faiss.serialize_index(index).nbytes
@@ -0,0 +1,107 @@
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# In-memory cache of generated answers. Crew members keep asking the same few
+# questions, and a full answer-model generation costs seconds. An entry is only
+# reused for the same role, the same corpus version, the same retrieved chunks
+# and the same chat history in the prompt, and only when the question
+# embedding is a near duplicate.
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("RAG_ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL = float(os.environ.get("RAG_ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("RAG_ANSWER_CACHE_SIMILARITY", "0.95"))
+
+_lock = threading.Lock()
+_ids = itertools.count()
+
+# entry id -> (bucket, unit question vector, answer, expires_at), in LRU order
+_entries = OrderedDict()
+
+# (role, corpus version, retrieved chunk ids, history digest) -> entry ids
+_buckets = {}
+
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _unit(q_embedding):
+    vector = np.asarray(q_embedding, dtype="float32").reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _remove(entry_id):
+    bucket = _entries.pop(entry_id)[0]
+    ids = _buckets.get(bucket)
+    if ids is not None:
+        ids.discard(entry_id)
+        if not ids:
+            del _buckets[bucket]
+
+
+def get_cached_answer(role, version, chunk_ids, q_embedding, history_digest=""):
+    """
+    Return a cached answer for a near-duplicate question, or None.
+
+    Args:
+        role: role view the question was asked against
+        version: Corpus.version of the snapshot that was searched
+        chunk_ids: positions of the retrieved chunks, in rank order
+        q_embedding: question embedding used for retrieval
+        history_digest: identifies the past turns included in the prompt
+            ("" for none); follow-ups like "explain more" depend on them
+    """
+    bucket = (role, version, tuple(chunk_ids), history_digest)
+    vector = _unit(q_embedding)
+    now = time.monotonic()
+
+    with _lock:
+        best_id, best_score = None, ANSWER_CACHE_SIMILARITY
+
+        for entry_id in list(_buckets.get(bucket, ())):
+            _, cached_vector, _, expires_at = _entries[entry_id]
+            if expires_at < now:
+                _remove(entry_id)
+                continue
+
+            score = float(np.dot(vector, cached_vector))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None:
+            _stats["misses"] += 1
+            return None
+
+        _stats["hits"] += 1
+        _entries.move_to_end(best_id)
+        return _entries[best_id][2]
+
+
+def put_cached_answer(role, version, chunk_ids, q_embedding, answer, history_digest=""):
+    """Store an answer and evict the least recently used entries beyond the size bound."""
+    bucket = (role, version, tuple(chunk_ids), history_digest)
+
+    with _lock:
+        entry_id = next(_ids)
+        _entries[entry_id] = (bucket, _unit(q_embedding), answer, time.monotonic() + ANSWER_CACHE_TTL)
+        _buckets.setdefault(bucket, set()).add(entry_id)
+
+        while len(_entries) > ANSWER_CACHE_MAX_ENTRIES:
+            _remove(next(iter(_entries)))
+            _stats["evictions"] += 1
+
+
+def invalidate_answers(version):
+    """Drop every answer generated against a corpus version other than this one."""
+    with _lock:
+        for entry_id, (bucket, _, _, _) in list(_entries.items()):
+            if bucket[1] != version:
+                _remove(entry_id)
+
+
+def answer_cache_stats():
+    with _lock:
+        return {**_stats, "entries": len(_entries)}
@@ -0,0 +1,98 @@
+"""
+Measure the chat-history DB time of /ask and /history as chat_history grows.
+
+Works on a scratch database (never users.db): fills chat_history in steps up
+to --rows and, at each size, times the queries each endpoint runs:
+
+    /ask      get_recent_chats(user, 5) + save_chat(...)
+    /history  get_recent_chats(user, 20)
+
+    python benchmark_db.py --rows 1000000 --users 200
+    python benchmark_db.py --no-index        # same, without (username, id) index
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix="chatdb-bench-")
+os.environ["RAG_DB_PATH"] = os.path.join(SCRATCH_DIR, "bench.db")
+
+import db  # noqa: E402  (must see RAG_DB_PATH)
+
+ANSWER = "A typical answer of a few hundred characters. " * 8
+
+
+def fill(conn, start, end, users):
+    rows = ((f"user{random.randrange(users)}", f"question {i}", ANSWER) for i in range(start, end))
+    with conn:
+        conn.executemany(db.INSERT_CHAT, rows)
+
+
+def timed(call, repeats):
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def connect_per_call_history(username):
+    # The pre-pool access pattern, for comparison
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        return conn.execute(db.SELECT_RECENT_CHATS, (username, 20)).fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--steps", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 3_000_000])
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--no-index", action="store_true")
+    args = parser.parse_args()
+
+    db.init_db()
+    conn = db.get_connection()
+    if args.no_index:
+        conn.execute("DROP INDEX IF EXISTS idx_chat_history_username_id")
+
+    print(f"Scratch database: {db.DB_PATH} (index: {'off' if args.no_index else 'on'})")
+    print(f"{'rows':>10} {'ask p50':>9} {'ask p99':>9} {'hist p50':>9} {'hist p99':>9} {'reconnect p50':>14}  (ms)")
+
+    filled = 0
+    for step in sorted(s for s in args.steps if s <= args.rows) or [args.rows]:
+        fill(conn, filled, step, args.users)
+        filled = step
+
+        def ask():
+            username = f"user{random.randrange(args.users)}"
+            db.get_recent_chats(username, 5)
+            db.save_chat(username, "benchmark question", ANSWER)
+
+        def history():
+            db.get_recent_chats(f"user{random.randrange(args.users)}", 20)
+
+        def reconnect():
+            connect_per_call_history(f"user{random.randrange(args.users)}")
+
+        ask_p50, ask_p99 = timed(ask, args.repeats)
+        history_p50, history_p99 = timed(history, args.repeats)
+        reconnect_p50, _ = timed(reconnect, args.repeats)
+
+        print(
+            f"{filled:>10} {ask_p50:>9.3f} {ask_p99:>9.3f} {history_p50:>9.3f} "
+            f"{history_p99:>9.3f} {reconnect_p50:>14.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
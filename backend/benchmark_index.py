@@ -0,0 +1,110 @@
+"""
+Compare the ANN index backends on the embeddings of the current corpus.
+
+Reads the per-document embeddings cached under index_cache/ (start the backend
+once so they exist), builds every index type over them and reports recall@k
+against an exact float32 Flat index, p50/p99 single-query latency and memory per vector.
+
+    python benchmark_index.py --k 5 --queries 500
+    python benchmark_index.py --questions questions.txt --nprobe 16 --ef-search 128
+    python benchmark_index.py --storage float16
+"""
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+from ann_index import INDEX_TYPES, VECTOR_STORAGES, VECTOR_STORAGE, create_ann_index, apply_search_params, index_memory_bytes
+from index_store import CACHE_DIR
+
+
+def load_corpus_embeddings():
+    paths = sorted(glob.glob(os.path.join(CACHE_DIR, "documents", "*.npy")))
+    if not paths:
+        raise SystemExit(f"No cached embeddings under {CACHE_DIR}/documents; start the backend once first")
+
+    return np.ascontiguousarray(np.concatenate([np.load(path) for path in paths]), dtype="float32")
+
+
+def load_queries(embeddings, count, questions_path=None, seed=0):
+    if questions_path:
+        # Only needed for real questions; the default samples corpus vectors
+        from sentence_transformers import SentenceTransformer
+
+        with open(questions_path, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        model = SentenceTransformer("all-MiniLM-L6-v2")
+        return np.asarray(model.encode(questions, normalize_embeddings=True), dtype="float32")
+
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(embeddings), size=min(count, len(embeddings)), replace=False)
+    return embeddings[picks]
+
+
+def search_all(index, queries, k):
+    """Search one query at a time, as /ask does. Returns (result ids, latencies in ms)."""
+    results = np.empty((len(queries), k), dtype="int64")
+    latencies = []
+
+    for row, query in enumerate(queries):
+        started = time.perf_counter()
+        _, I = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results[row] = I[0]
+
+    return results, np.asarray(latencies)
+
+
+def recall_at_k(results, truth):
+    hits = sum(len(set(found[found >= 0]) & set(expected)) for found, expected in zip(results, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=500, help="corpus vectors sampled as queries")
+    parser.add_argument("--questions", help="text file with one question per line, used instead of sampling")
+    parser.add_argument("--nprobe", type=int, help="override RAG_IVF_NPROBE")
+    parser.add_argument("--ef-search", type=int, help="override RAG_HNSW_EF_SEARCH")
+    parser.add_argument("--storage", default=VECTOR_STORAGE, choices=list(VECTOR_STORAGES))
+    args = parser.parse_args()
+
+    embeddings = load_corpus_embeddings()
+    queries = load_queries(embeddings, args.queries, args.questions)
+    k = min(args.k, len(embeddings))
+
+    print(f"{len(embeddings)} vectors of dimension {embeddings.shape[1]}, {len(queries)} queries, k={k}\n")
+
+    truth, _ = search_all(create_ann_index(embeddings, "flat", "float32"), queries, k)
+
+    print(f"storage={args.storage}")
+    print(f"{'index':<10} {'build s':>8} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8} {'bytes/vec':>10}")
+
+    for index_type in args.types:
+        started = time.perf_counter()
+        index = create_ann_index(embeddings, index_type, args.storage)
+        build_seconds = time.perf_counter() - started
+
+        search_params = {}
+        if args.nprobe is not None:
+            search_params["nprobe"] = args.nprobe
+        if args.ef_search is not None:
+            search_params["ef_search"] = args.ef_search
+        if search_params:
+            apply_search_params(index, **search_params)
+
+        results, latencies = search_all(index, queries, k)
+
+        print(
+            f"{index_type:<10} {build_seconds:>8.2f} {recall_at_k(results, truth):>9.3f} "
+            f"{np.percentile(latencies, 50):>8.3f} {np.percentile(latencies, 99):>8.3f} "
+            f"{index_memory_bytes(index) / index.ntotal:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
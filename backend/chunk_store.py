@@ -0,0 +1,84 @@
+import mmap
+import os
+
+import numpy as np
+
+# Read-only columns of a role view that live in memory-mapped files, so every
+# worker process shares one copy through the page cache instead of holding its
+# own Python strings.
+
+
+class ChunkStore:
+    """
+    List-like, read-only sequence of chunk texts stored as one UTF-8 blob.
+    Chunk i is blob[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def write(blob_path, offsets_path, chunks):
+        encoded = [chunk.encode("utf-8") for chunk in chunks]
+
+        offsets = np.zeros(len(encoded) + 1, dtype="int64")
+        np.cumsum(np.fromiter((len(data) for data in encoded), dtype="int64", count=len(encoded)), out=offsets[1:])
+
+        with open(blob_path, "wb") as f:
+            for data in encoded:
+                f.write(data)
+        with open(offsets_path, "wb") as f:
+            np.save(f, offsets)
+
+    @classmethod
+    def open(cls, blob_path, offsets_path):
+        offsets = np.load(offsets_path, mmap_mode="r")
+
+        if os.path.getsize(blob_path) == 0:
+            return cls(b"", offsets)
+
+        with open(blob_path, "rb") as f:
+            # The mapping stays valid after the file object is closed
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("chunk index out of range")
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class SourceColumn:
+    """Per-chunk source filename, stored as int32 codes into a short list of names."""
+
+    def __init__(self, codes, names):
+        self.codes = codes
+        self.names = names
+
+    @staticmethod
+    def encode(sources):
+        """Returns (int32 codes, names) for a list of per-chunk source names."""
+        names = sorted(set(sources))
+        positions = {name: position for position, name in enumerate(names)}
+        return np.array([positions[source] for source in sources], dtype="int32"), names
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.names[int(self.codes[i])]
+
+    def __iter__(self):
+        for code in self.codes:
+            yield self.names[int(code)]
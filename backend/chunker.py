@@ -0,0 +1,207 @@
+import os
+import re
+from collections import Counter
+
+# ----------- SPLIT TEXT INTO CHUNKS -----------
+# Running page headers and footers are stripped first. Chunks are then packed
+# from whole sentences up to CHUNK_TOKENS, start afresh at headings and
+# "RULE N" lines (a run of headings stays with the text after it), carry
+# CHUNK_OVERLAP_TOKENS of trailing sentences into the next chunk, and run
+# across page boundaries so a rule that continues on the next page stays in
+# one chunk. all-MiniLM-L6-v2 truncates its input at
+# 256 word pieces, so larger chunks would not be embedded in full anyway.
+CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", "200"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("RAG_CHUNK_OVERLAP_TOKENS", "40"))
+# Smaller leftovers are merged into the previous chunk instead of being indexed alone
+CHUNK_MIN_TOKENS = int(os.environ.get("RAG_CHUNK_MIN_TOKENS", "24"))
+
+# Running headers and footers: lines repeated among the first or last
+# RUNNING_LINE_EDGE lines of at least RUNNING_LINE_MIN_PAGES pages
+RUNNING_LINE_EDGE = 3
+RUNNING_LINE_MIN_PAGES = 3
+RUNNING_LINE_MAX_WORDS = 12
+PAGE_NUMBER_LINE = re.compile(r"^(page\s*)?[-–—\s]*\d+[-–—\s]*(of\s+\d+)?$", re.IGNORECASE)
+
+SENTENCE_END = re.compile(r"(?<=[.!?;])\s+(?=[\"'(\[]?[A-Z0-9])")
+HEADING_PATTERNS = [
+    re.compile(r"^RULE\s+\d+", re.IGNORECASE),
+    re.compile(r"^(PART|SECTION|CHAPTER|ANNEX|APPENDIX)\s+[\w.]+", re.IGNORECASE),
+    re.compile(r"^\d+(\.\d+)*\.?\s+[A-Z][^.]{0,80}$"),       # "3.2 Fire Pumps"
+]
+MAX_HEADING_WORDS = 12
+# "RULE 27—CONTINUED" repeats a title at a page break; the rule text carries on
+CONTINUATION_PATTERN = re.compile(r"\bCONTINUED\b", re.IGNORECASE)
+
+
+def estimate_tokens(text):
+    """Word-piece estimate used when no tokenizer is passed in."""
+    return max(1, round(len(text.split()) * 1.3))
+
+
+def is_heading(line):
+    if len(line.split()) > MAX_HEADING_WORDS:
+        return False
+    if any(pattern.match(line) for pattern in HEADING_PATTERNS):
+        return True
+    # Short all-caps lines such as "GENERAL PROVISIONS"
+    letters = [c for c in line if c.isalpha()]
+    return len(letters) >= 4 and all(c.isupper() for c in letters)
+
+
+def _edge_positions(lines):
+    content = [i for i, line in enumerate(lines) if 0 < len(line.split()) <= RUNNING_LINE_MAX_WORDS]
+    return set(content[:RUNNING_LINE_EDGE] + content[-RUNNING_LINE_EDGE:])
+
+
+def strip_running_lines(pages, min_pages=RUNNING_LINE_MIN_PAGES):
+    """
+    Drop page headers and footers such as "—INTERNATIONAL— Lights and Shapes"
+    or "Page 12": lines found at the top or bottom of many pages, and bare
+    page numbers there.
+    """
+    split_pages = [page["text"].splitlines() for page in pages]
+
+    counts = Counter()
+    for lines in split_pages:
+        counts.update({" ".join(lines[i].split()) for i in _edge_positions(lines)})
+    running = {line for line, count in counts.items() if count >= min_pages}
+
+    stripped = []
+    for page, lines in zip(pages, split_pages):
+        drop = {
+            i for i in _edge_positions(lines)
+            if " ".join(lines[i].split()) in running or PAGE_NUMBER_LINE.match(lines[i].strip())
+        }
+        text = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+        stripped.append({**page, "text": text})
+
+    return stripped
+
+
+def page_units(pages):
+    """
+    Break page text into headings and sentences.
+
+    Returns:
+        list of (text, page number, is heading) in reading order
+    """
+    units = []
+
+    for page in pages:
+        paragraph = []
+
+        def flush_paragraph():
+            if paragraph:
+                for sentence in SENTENCE_END.split(" ".join(paragraph)):
+                    if sentence.strip():
+                        units.append((sentence.strip(), page["page"], False))
+                paragraph.clear()
+
+        for line in page["text"].splitlines():
+            line = " ".join(line.split())
+            if not line:
+                flush_paragraph()
+            elif is_heading(line) and CONTINUATION_PATTERN.search(line):
+                continue
+            elif is_heading(line):
+                flush_paragraph()
+                units.append((line, page["page"], True))
+            else:
+                paragraph.append(line)
+
+        flush_paragraph()
+
+    return units
+
+
+def _split_long_unit(text, page, count_tokens, chunk_tokens):
+    """Word windows for a single sentence that is longer than a chunk."""
+    words = text.split()
+    step = max(1, len(words) * chunk_tokens // count_tokens(text))
+    return [(" ".join(words[i:i + step]), page, False) for i in range(0, len(words), step)]
+
+
+def chunk_pages(pages, count_tokens=None, chunk_tokens=CHUNK_TOKENS,
+                overlap_tokens=CHUNK_OVERLAP_TOKENS, min_tokens=CHUNK_MIN_TOKENS):
+    """
+    Split parsed pages of one document into structure-aware chunks.
+
+    Args:
+        pages: list of {"page", "text"} in page order
+        count_tokens: callable returning the token count of a string;
+            defaults to a word-based estimate
+
+    Returns:
+        (chunks, page spans): chunk texts and the (first page, last page) each covers
+    """
+    count_tokens = count_tokens or estimate_tokens
+
+    chunks = []
+    spans = []
+    current = []    # (text, page, tokens, is heading, carried over from the previous chunk)
+    current_tokens = 0
+
+    def new_units():
+        return [unit for unit in current if not unit[4]]
+
+    def emit(keep_overlap):
+        nonlocal current, current_tokens
+
+        added = new_units()
+        if not added:
+            # Only overlap from the previous chunk: nothing new to index
+            current, current_tokens = [], 0
+            return
+
+        if chunks and sum(unit[2] for unit in added) < min_tokens:
+            # Too small to stand alone; append the new text to the previous chunk
+            chunks[-1] += " " + " ".join(unit[0] for unit in added)
+            spans[-1] = (spans[-1][0], max(spans[-1][1], added[-1][1]))
+            current, current_tokens = [], 0
+            return
+
+        chunks.append(" ".join(unit[0] for unit in current))
+        spans.append((current[0][1], current[-1][1]))
+
+        carried = []
+        carried_tokens = 0
+        if keep_overlap:
+            for unit in reversed(current[1:]):
+                if unit[3] or carried_tokens + unit[2] > overlap_tokens:
+                    break
+                carried.insert(0, unit[:4] + (True,))
+                carried_tokens += unit[2]
+
+        current, current_tokens = carried, carried_tokens
+
+    for text, page, heading in page_units(strip_running_lines(pages)):
+        if heading:
+            added = new_units()
+            if any(not unit[3] for unit in added) and sum(unit[2] for unit in added) >= min_tokens:
+                emit(keep_overlap=False)
+            elif not added:
+                # A section starts right after a split: drop the overlap, it belongs to the last section
+                current, current_tokens = [], 0
+            # Otherwise the heading joins a run of headings or a chunk too small to stand alone
+
+        tokens = count_tokens(text)
+        pieces = [(text, page, heading)]
+        if tokens > chunk_tokens:
+            pieces = _split_long_unit(text, page, count_tokens, chunk_tokens)
+
+        for piece_text, piece_page, piece_heading in pieces:
+            piece_tokens = count_tokens(piece_text) if len(pieces) > 1 else tokens
+            if current and current_tokens + piece_tokens > chunk_tokens:
+                emit(keep_overlap=True)
+            current.append((piece_text, piece_page, piece_tokens, piece_heading, False))
+            current_tokens += piece_tokens
+
+    emit(keep_overlap=False)
+
+    return chunks, spans
+
+
+def split_text(text, count_tokens=None):
+    """Chunk a single block of text, e.g. a whole PDF read by load_pdf_text."""
+    chunks, _ = chunk_pages([{"page": 0, "text": text}], count_tokens)
+    return chunks
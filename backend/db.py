@@ -1,11 +1,65 @@
+import os
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
 
+# Hashes below the current cost factor are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.environ.get("RAG_BCRYPT_ROUNDS", "12"))
+
 # Use passlib to hash & verify passwords
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS
+)
+
+DB_PATH = os.environ.get("RAG_DB_PATH", "users.db")
+
+# One long-lived connection per thread instead of a connect/close per call.
+# sqlite3 keeps a per-connection cache of prepared statements, so the fixed SQL
+# strings below are compiled once per thread and then reused.
+_local = threading.local()
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",          # readers never block the writer
+    "PRAGMA synchronous=NORMAL",        # fsync at checkpoints, not on every commit
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",         # 16 MB page cache
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+]
+
+SELECT_USER = "SELECT * FROM users WHERE username=?"
+INSERT_USER = "INSERT INTO users (username, password, role) VALUES (?, ?, ?)"
+UPDATE_PASSWORD = "UPDATE users SET password=? WHERE username=?"
+INSERT_CHAT = "INSERT INTO chat_history (username, question, answer) VALUES (?, ?, ?)"
+SELECT_RECENT_CHATS = """
+    SELECT question, answer
+    FROM chat_history
+    WHERE username=?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+
+
+def get_connection():
+    """Return this thread's connection, opening and tuning it on first use."""
+    conn = getattr(_local, "conn", None)
+
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+
+    return conn
+
 
 def init_db():
-    conn = sqlite3.connect("users.db")
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -27,92 +81,274 @@ def init_db():
     )
 """)
 
+    # get_recent_chats filters by user and walks newest-first by id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_username_id ON chat_history (username, id)")
 
     conn.commit()
-    conn.close()
 
 
-def create_user(username, password, role):
-    """Create a user and store a hashed password. Raises ValueError on duplicate username."""
-    hashed = pwd_context.hash(password)
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+# ----------- PASSWORD HASHING -----------
+# bcrypt is deliberately slow. It runs on its own small pool so a burst of
+# logins queues here instead of occupying the threads that serve /ask.
+PASSWORD_WORKERS = int(os.environ.get("RAG_PASSWORD_WORKERS", "2"))
+
+
+class PasswordPool:
+    """Bounded executor for bcrypt work that tracks queueing and run time."""
+
+    def __init__(self, workers=PASSWORD_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "running": 0,
+            "max_queue_depth": 0,
+            "wait_seconds": 0.0,
+            "run_seconds": 0.0
+        }
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on the pool. Returns a concurrent Future."""
+        queued_at = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            with self.lock:
+                self.metrics["running"] += 1
+                self.metrics["wait_seconds"] += started - queued_at
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.metrics["running"] -= 1
+                    self.metrics["completed"] += 1
+                    self.metrics["run_seconds"] += time.perf_counter() - started
+
+        with self.lock:
+            self.metrics["submitted"] += 1
+            depth = self.metrics["submitted"] - self.metrics["completed"] - self.metrics["running"]
+            self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], depth)
+
+        return self.executor.submit(task)
+
+    def stats(self):
+        with self.lock:
+            metrics = dict(self.metrics)
 
+        completed = metrics["completed"]
+        return {
+            **metrics,
+            "workers": self.workers,
+            "queue_depth": metrics["submitted"] - completed - metrics["running"],
+            "avg_wait_ms": round(metrics["wait_seconds"] * 1000 / completed, 1) if completed else 0.0,
+            "avg_run_ms": round(metrics["run_seconds"] * 1000 / completed, 1) if completed else 0.0
+        }
+
+
+password_pool = PasswordPool()
+
+
+def _check_password(password, stored_password):
+    """
+    Returns:
+        (matches, replacement hash or None): a replacement is returned when the
+        stored value is plaintext (older DB) or hashed below the current cost
+    """
     try:
-        cursor.execute(
-            "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-            (username, hashed, role)
-        )
-        conn.commit()
+        return pwd_context.verify_and_update(password, stored_password)
+    except (ValueError, TypeError):
+        # stored_password may be plaintext (older DB) — fallback to plain comparison
+        if stored_password == password:
+            return True, pwd_context.hash(password)
+        return False, None
+
+
+def hash_password(password):
+    """Future resolving to the bcrypt hash of the password."""
+    return password_pool.submit(pwd_context.hash, password)
+
+
+def check_password(password, stored_password):
+    """Future resolving to (matches, replacement hash or None)."""
+    return password_pool.submit(_check_password, password, stored_password)
+
+
+def insert_user(username, hashed, role):
+    """Store a user with an already hashed password. Raises ValueError on duplicate username."""
+    conn = get_connection()
+
+    try:
+        with conn:
+            conn.execute(INSERT_USER, (username, hashed, role))
     except sqlite3.IntegrityError:
         raise ValueError("Username already exists")
-    finally:
-        conn.close()
 
 
-def get_user(username, password):
-    """Return user row if username/password match. Supports migrating plaintext passwords on first login."""
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+def find_user(username):
+    return get_connection().execute(SELECT_USER, (username,)).fetchone()
+
+
+def update_password_hash(username, hashed):
+    conn = get_connection()
+
+    with conn:
+        conn.execute(UPDATE_PASSWORD, (hashed, username))
 
-    cursor.execute(
-        "SELECT * FROM users WHERE username=?",
-        (username,)
-    )
 
-    user = cursor.fetchone()
+def create_user(username, password, role):
+    """Create a user and store a hashed password. Raises ValueError on duplicate username."""
+    insert_user(username, hash_password(password).result(), role)
+
+
+def get_user(username, password):
+    """
+    Return user row if username/password match. Migrates plaintext passwords and
+    upgrades hashes below the current cost factor on a successful login.
+    """
+    user = find_user(username)
 
     if not user:
-        conn.close()
         return None
 
-    stored_password = user[2]  # password column
+    matches, new_hash = check_password(password, user[2]).result()  # password column
 
-    # First try verifying as a hashed password
-    try:
-        if pwd_context.verify(password, stored_password):
-            conn.close()
-            return user
-    except Exception:
-        # stored_password may be plaintext (older DB) — fallback to plain comparison
-        if stored_password == password:
-            # upgrade stored password to a hash
-            new_hash = pwd_context.hash(password)
-            cursor.execute("UPDATE users SET password=? WHERE username=?", (new_hash, username))
-            conn.commit()
-            conn.close()
-            return user
+    if not matches:
+        return None
 
-    conn.close()
-    return None
+    if new_hash:
+        update_password_hash(username, new_hash)
 
-def save_chat(username, question, answer):
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+    return user
 
-    cursor.execute(
-        "INSERT INTO chat_history (username, question, answer) VALUES (?, ?, ?)",
-        (username, question, answer)
-    )
 
-    conn.commit()
-    conn.close()
+# ----------- CHAT LOG WRITER -----------
+CHAT_BATCH_SIZE = int(os.environ.get("RAG_CHAT_BATCH_SIZE", "64"))
+CHAT_FLUSH_INTERVAL = float(os.environ.get("RAG_CHAT_FLUSH_INTERVAL", "0.2"))
 
 
-def get_recent_chats(username, limit=5):
-    conn = sqlite3.connect("users.db")
-    cursor = conn.cursor()
+class ChatWriter:
+    """
+    Write-behind log for chat turns. save() only queues the turn; a background
+    thread commits queued turns in one transaction once CHAT_BATCH_SIZE are
+    waiting or CHAT_FLUSH_INTERVAL seconds after the first one, so concurrent
+    requests share one fsync instead of paying one each.
 
-    cursor.execute("""
-        SELECT question, answer
-        FROM chat_history
-        WHERE username=?
-        ORDER BY id DESC
-        LIMIT ?
-    """, (username, limit))
+    The writer's connection runs with synchronous=FULL: once a batch commit
+    returns, those turns are durable.
+    """
+
+    def __init__(self, batch_size=CHAT_BATCH_SIZE, flush_interval=CHAT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.condition = threading.Condition()
+        self.pending = []           # (username, question, answer), oldest first
+        self.writing = False        # a batch is being committed right now
+        self.generation = 0         # completed batch commits
+        self.enqueued = 0
+        self.committed = 0
+        self.flush_requested = False
+        self.thread = None
+
+    def save(self, username, question, answer):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+                self.thread.start()
+
+            self.pending.append((username, question, answer))
+            self.enqueued += 1
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Block until every turn queued before this call is committed. Returns False on timeout."""
+        with self.condition:
+            target = self.enqueued
+            self.flush_requested = True
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: self.committed >= target, timeout)
+
+    def recent(self, username, limit):
+        """
+        Latest turns of a user, oldest first, including turns still queued.
 
-    rows = cursor.fetchall()
-    conn.close()
+        A batch that is mid-commit could show up both in the table and in the
+        queue snapshot, so reads wait for it and retry if one landed meanwhile.
+        """
+        conn = get_connection()
 
-    return rows[::-1]  # return oldest → newest
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.writing)
+                generation = self.generation
+                queued = [(q, a) for u, q, a in self.pending if u == username]
+
+            rows = conn.execute(SELECT_RECENT_CHATS, (username, limit)).fetchall()
+
+            with self.condition:
+                if generation == self.generation and not self.writing:
+                    break
+
+        return (rows[::-1] + queued)[-limit:]
+
+    def _next_batch(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending)
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(self.pending) < self.batch_size and not self.flush_requested:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = self.pending[:self.batch_size * 4]
+            del self.pending[:len(batch)]
+            self.flush_requested = bool(self.pending) and self.flush_requested
+            self.writing = True
+
+        return batch
+
+    def _run(self):
+        conn = get_connection()
+        conn.execute("PRAGMA synchronous=FULL")
+
+        while True:
+            batch = self._next_batch()
+
+            try:
+                with conn:
+                    conn.executemany(INSERT_CHAT, batch)
+            except sqlite3.Error as e:
+                print(f"Chat log write failed, retrying: {e}")
+                with self.condition:
+                    self.pending[:0] = batch
+                    self.writing = False
+                    self.condition.notify_all()
+                time.sleep(self.flush_interval)
+                continue
+
+            with self.condition:
+                self.writing = False
+                self.generation += 1
+                self.committed += len(batch)
+                self.condition.notify_all()
+
+
+chat_writer = ChatWriter()
+
+
+def save_chat(username, question, answer):
+    """Queue a chat turn; it is committed by the background writer shortly after."""
+    chat_writer.save(username, question, answer)
+
+
+def flush_chats(timeout=None):
+    return chat_writer.flush(timeout)
+
+
+def get_recent_chats(username, limit=5):
+    return chat_writer.recent(username, limit)  # return oldest → newest
 
@@ -0,0 +1,447 @@
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+
+from ann_index import storage_dtype, is_ivf_index
+from chunk_store import ChunkStore, SourceColumn
+
+try:
+    import fcntl
+except ImportError:     # Windows: single-worker deployments only
+    fcntl = None
+
+# On-disk cache of per-document chunks/embeddings and the published corpus generations.
+# Documents are keyed by the sha256 of the PDF bytes, so renaming or touching a
+# file does not force a re-embed, while any content change does.
+CACHE_DIR = "index_cache"
+
+# Bump whenever chunking or embedding changes so stale entries are rebuilt
+STORE_VERSION = 5
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def corpus_key(digests, variant=""):
+    """
+    Stable key for a set of documents, used to validate persisted indexes.
+
+    Args:
+        digests: dict mapping filename -> content digest
+        variant: describes how the indexes were built (e.g. the ANN index type)
+    """
+    sha = hashlib.sha256(f"v{STORE_VERSION}:{variant}".encode())
+    for name, digest in sorted(digests.items()):
+        sha.update(f"{name}:{digest}\n".encode())
+    return sha.hexdigest()
+
+
+def _document_paths(digest):
+    return (
+        os.path.join(CACHE_DIR, "documents", f"{digest}.json"),
+        os.path.join(CACHE_DIR, "documents", f"{digest}.npy"),
+    )
+
+
+def _atomic_write(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_json(path, data):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+    _atomic_write(path, write)
+
+
+def _write_array(path, array):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+
+    _atomic_write(path, write)
+
+
+def _write_arrays(path, arrays):
+    def write(tmp_path):
+        # Through a file object so numpy does not append ".npz" to the temp name
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+
+    _atomic_write(path, write)
+
+
+# ----------- PER-DOCUMENT CACHE -----------
+def load_cached_document(digest):
+    """
+    Load cached chunks and embeddings for a PDF content hash.
+
+    Returns:
+        dict with "chunks", "pages" and a memory-mapped "embeddings" matrix,
+        or None if the document has not been processed with this STORE_VERSION
+    """
+    meta_path, embeddings_path = _document_paths(digest)
+
+    if not (os.path.exists(meta_path) and os.path.exists(embeddings_path)):
+        return None
+
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            document = json.load(f)
+        if document.get("version") != STORE_VERSION:
+            return None
+        document["embeddings"] = np.load(embeddings_path, mmap_mode="r")
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache entry {digest}: {e}")
+        return None
+
+    return document
+
+
+def save_cached_document(digest, document):
+    meta_path, embeddings_path = _document_paths(digest)
+
+    meta = {k: v for k, v in document.items() if k != "embeddings"}
+    meta["version"] = STORE_VERSION
+
+    # Embeddings first: a metadata file is only ever visible next to its matrix.
+    # Stored as float16 when the index is compressed too (RAG_VECTOR_STORAGE).
+    _write_array(embeddings_path, np.asarray(document["embeddings"], dtype=storage_dtype()))
+    _write_json(meta_path, meta)
+
+
+def prune_cached_documents(keep_digests):
+    """Remove cache entries for documents that are no longer in the corpus."""
+    folder = os.path.join(CACHE_DIR, "documents")
+    if not os.path.isdir(folder):
+        return
+
+    for name in os.listdir(folder):
+        digest = name.split(".")[0]
+        if digest not in keep_digests:
+            os.remove(os.path.join(folder, name))
+
+
+# ----------- CORPUS GENERATIONS -----------
+# Every published corpus is a numbered, read-only directory under generations/:
+# the FAISS index, chunk texts, per-chunk sources and page spans, and BM25
+# postings of each role view, all opened memory-mapped. Any number of uvicorn
+# workers map the same files and share one copy through the page cache.
+# CURRENT names the generation to serve; workers poll it to pick up uploads.
+GENERATIONS_KEPT = int(os.environ.get("RAG_GENERATIONS_KEPT", "3"))
+
+# IO_FLAG_MMAP maps IVF inverted lists; IO_FLAG_MMAP_IFC (faiss >= 1.11) maps
+# the codes of Flat and scalar-quantizer indexes and HNSW storage. Neither
+# raises for the other kind (the index is just read into RAM) and faiss rejects
+# the two combined, so the manifest records which one each role index needs.
+IVF_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+FLAT_CODES_MMAP_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+
+
+def _generations_dir():
+    return os.path.join(CACHE_DIR, "generations")
+
+
+def _generation_dir(generation):
+    return os.path.join(_generations_dir(), f"{generation:08d}")
+
+
+def _role_paths(folder, position):
+    # Roles come from upload filenames, so never use them as path components
+    prefix = os.path.join(folder, f"role_{position}")
+    return {
+        "index": prefix + ".faiss",
+        "chunks": prefix + ".chunks.bin",
+        "offsets": prefix + ".chunks.offsets.npy",
+        "sources": prefix + ".sources.npy",
+        "spans": prefix + ".spans.npy",
+        "terms": prefix + ".terms.json",
+    }
+
+
+def _lexical_array_path(folder, position, name):
+    return os.path.join(folder, f"role_{position}.bm25.{name}.npy")
+
+
+LEXICAL_ARRAYS = ("offsets", "doc_ids", "weights", "size")
+
+
+def _link_role_files(stored, folder, position):
+    """
+    Carry a role view that an upload did not touch over from its generation.
+
+    Its index may be memory-mapped from those files, and faiss.write_index on a
+    memory-mapped IVF index writes a reference to the old file instead of the
+    lists, so the files are hard-linked (or copied) rather than re-serialized.
+    """
+    generation, stored_position = stored
+    stored_folder = _generation_dir(generation)
+
+    pairs = list(zip(_role_paths(stored_folder, stored_position).values(), _role_paths(folder, position).values()))
+    pairs += [
+        (_lexical_array_path(stored_folder, stored_position, name), _lexical_array_path(folder, position, name))
+        for name in LEXICAL_ARRAYS
+    ]
+
+    for source, target in pairs:
+        if not os.path.exists(source):
+            continue
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+    with open(os.path.join(stored_folder, "manifest.json"), encoding="utf-8") as f:
+        return json.load(f)["roles"][stored_position]
+
+
+@contextmanager
+def generation_lock():
+    """
+    Cross-process lock around building and publishing generations, so two
+    workers never ingest at the same time or both rebuild the corpus on startup.
+    """
+    os.makedirs(_generations_dir(), exist_ok=True)
+
+    with open(os.path.join(_generations_dir(), ".lock"), "a") as f:
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def claim_exclusive(name):
+    """
+    Non-blocking cross-process claim, e.g. for a startup job only one worker
+    should run.
+
+    Returns:
+        an open file that holds the claim until it is closed, or None if
+        another process holds it
+    """
+    os.makedirs(_generations_dir(), exist_ok=True)
+    f = open(os.path.join(_generations_dir(), f".{name}.lock"), "a")
+
+    if fcntl is not None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+
+    return f
+
+
+def read_current_generation():
+    """
+    Returns:
+        {"generation", "key"} of the generation being served, or None
+    """
+    path = os.path.join(_generations_dir(), "CURRENT")
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable generation pointer: {e}")
+        return None
+
+
+def _existing_generations():
+    if not os.path.isdir(_generations_dir()):
+        return []
+    return sorted(int(name) for name in os.listdir(_generations_dir()) if name.isdigit())
+
+
+def _prune_generations(current):
+    # Workers that have not swapped yet keep their mappings even if the files go
+    # away (POSIX), but the last few are kept so a slow poller can still open one
+    for generation in _existing_generations()[:-GENERATIONS_KEPT]:
+        if generation == current:
+            continue
+        try:
+            shutil.rmtree(_generation_dir(generation))
+        except OSError as e:
+            print(f"Could not remove corpus generation {generation}: {e}")
+
+
+def write_generation(key, documents, role_views, page_images, rule_pages):
+    """
+    Write a new generation and make it CURRENT. Call under generation_lock().
+
+    Args:
+        documents: dict mapping filename -> {"digest", "role", "chunk_count"}
+        role_views: dict mapping role -> {"index", "chunks", "sources", "page_spans", "lexical"},
+            where "lexical" is None or the (terms, postings arrays) of a LexicalIndex;
+            or {"stored": (generation, position)} for a view whose files are reused as they are
+        page_images: dict mapping (source, page) -> image names
+        rule_pages: dict mapping rule number -> set of (source, page)
+
+    Returns:
+        the new generation number
+    """
+    existing = _existing_generations()
+    generation = existing[-1] + 1 if existing else 1
+
+    folder = _generation_dir(generation)
+    tmp_folder = folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    roles = []
+    for position, role in enumerate(sorted(role_views)):
+        view = role_views[role]
+
+        if view.get("stored") is not None:
+            roles.append({**_link_role_files(view["stored"], tmp_folder, position), "role": role})
+            continue
+
+        paths = _role_paths(tmp_folder, position)
+        faiss.write_index(view["index"], paths["index"])
+        ChunkStore.write(paths["chunks"], paths["offsets"], view["chunks"])
+
+        codes, names = SourceColumn.encode(list(view["sources"]))
+        np.save(paths["sources"], codes)
+        np.save(paths["spans"], np.asarray(view["page_spans"], dtype="int32").reshape(-1, 2))
+
+        if view["lexical"] is not None:
+            terms, arrays = view["lexical"]
+            with open(paths["terms"], "w", encoding="utf-8") as f:
+                json.dump(terms, f)
+            for name, array in arrays.items():
+                np.save(_lexical_array_path(tmp_folder, position, name), array)
+
+        roles.append({
+            "role": role,
+            "sources": names,
+            "lexical": view["lexical"] is not None,
+            "ivf": is_ivf_index(view["index"]),
+        })
+
+    with open(os.path.join(tmp_folder, "lookups.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "page_images": [[source, page, names] for (source, page), names in page_images.items()],
+            "rule_pages": {rule: sorted(locations) for rule, locations in rule_pages.items()},
+        }, f)
+
+    manifest = {
+        "key": key,
+        "documents": documents,
+        "roles": roles,
+    }
+    # Manifest last inside the directory, then the directory itself is renamed into place
+    with open(os.path.join(tmp_folder, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_folder, folder)
+
+    _write_json(os.path.join(_generations_dir(), "CURRENT"), {"generation": generation, "key": key})
+    _prune_generations(generation)
+
+    return generation
+
+
+def open_generation(generation):
+    """
+    Memory-map every file of a published generation.
+
+    Returns:
+        dict with "generation", "key", "documents", "page_images", "rule_pages" and
+        "roles": role -> {"index", "chunks", "sources", "page_spans", "lexical", "stored"}
+    """
+    folder = _generation_dir(generation)
+
+    with open(os.path.join(folder, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    with open(os.path.join(folder, "lookups.json"), encoding="utf-8") as f:
+        lookups = json.load(f)
+
+    roles = {}
+    for position, entry in enumerate(manifest["roles"]):
+        paths = _role_paths(folder, position)
+
+        try:
+            flags = IVF_MMAP_FLAGS if entry.get("ivf") else FLAT_CODES_MMAP_FLAGS
+            index = faiss.read_index(paths["index"], flags)
+        except RuntimeError:
+            # Not every index type supports memory-mapping; load those into RAM
+            print(f"Loading {paths['index']} into memory; it cannot be memory-mapped")
+            index = faiss.read_index(paths["index"])
+
+        lexical = None
+        if entry["lexical"]:
+            with open(paths["terms"], encoding="utf-8") as f:
+                terms = json.load(f)
+            arrays = {
+                name: np.load(_lexical_array_path(folder, position, name), mmap_mode="r")
+                for name in LEXICAL_ARRAYS
+            }
+            lexical = (terms, arrays)
+
+        roles[entry["role"]] = {
+            "index": index,
+            "chunks": ChunkStore.open(paths["chunks"], paths["offsets"]),
+            "sources": SourceColumn(np.load(paths["sources"], mmap_mode="r"), entry["sources"]),
+            "page_spans": np.load(paths["spans"], mmap_mode="r"),
+            "lexical": lexical,
+            "stored": (generation, position),
+        }
+
+    return {
+        "generation": generation,
+        "key": manifest["key"],
+        "documents": manifest["documents"],
+        "page_images": {(source, page): names for source, page, names in lookups["page_images"]},
+        "rule_pages": {
+            rule: {(source, page) for source, page in locations}
+            for rule, locations in lookups["rule_pages"].items()
+        },
+        "roles": roles,
+    }
+
+
+# ----------- IMAGE MANIFEST -----------
+def _image_manifest_path():
+    return os.path.join(CACHE_DIR, "image_manifest.json")
+
+
+def load_image_manifest():
+    """
+    Returns:
+        dict mapping PDF filename -> {"digest", "images": [{"page", "index", "xref", "name", "sha1"}]}
+    """
+    path = _image_manifest_path()
+
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable image manifest: {e}")
+        return {}
+
+
+def save_image_manifest(manifest):
+    _write_json(_image_manifest_path(), manifest)
@@ -0,0 +1,179 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from chunker import chunk_pages
+from pdf_parser import (
+    count_pages, find_rule_pages, image_manifest_state, load_image_manifest, parse_page_range, record_images
+)
+
+# Parsing is independent per PDF (and per page range), so it runs in a process
+# pool. The parent chunks each document once all of its ranges are in, so
+# chunks can run across range and page boundaries, and embeds them in batches.
+# This module must not import rag_engine: spawned workers would load the model.
+INGEST_WORKERS = int(os.environ.get("RAG_INGEST_WORKERS", os.cpu_count() or 1))
+PAGES_PER_TASK = int(os.environ.get("RAG_INGEST_PAGES_PER_TASK", "32"))
+EMBED_BATCH_SIZE = int(os.environ.get("RAG_EMBED_BATCH_SIZE", "256"))
+
+
+def _parse_task(pdf_path, pdf_name, start, end, known, current_images):
+    started = time.perf_counter()
+
+    pages, images = parse_page_range(pdf_path, pdf_name, start, end, known, current_images)
+
+    return {
+        "file": pdf_name,
+        "start": start,
+        "pages": pages,
+        "images": images,
+        "seconds": time.perf_counter() - started
+    }
+
+
+def _page_ranges(pdf_path, workers):
+    if workers <= 1:
+        return [(0, None)]
+
+    page_count = count_pages(pdf_path)
+    return [
+        (start, min(start + PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PAGES_PER_TASK)
+    ] or [(0, 0)]
+
+
+def ingest_pdfs(folder, jobs, embed, dimension, count_tokens=None, workers=INGEST_WORKERS):
+    """
+    Parse, chunk and embed PDFs. Large PDFs are split into page ranges and
+    spread across worker processes; each finished document is chunked and
+    streamed into batched embed() calls in this process while the workers
+    keep parsing.
+
+    Args:
+        jobs: list of (filename, content digest)
+        embed: callable mapping a list of texts to a float32 matrix
+        dimension: embedding dimension, for documents without text
+        count_tokens: tokenizer-backed token counter for chunk sizes
+
+    Returns:
+        (documents, timings): filename -> {"chunks", "pages", "page_spans", "page_texts",
+        "rule_pages", "embeddings"}, and filename -> {"pages", "chunks", "parse_seconds", "elapsed_seconds"}
+    """
+    started = time.perf_counter()
+    manifest = load_image_manifest()
+
+    state = {}
+    tasks = []
+
+    for file, digest in jobs:
+        path = os.path.join(folder, file)
+        known, current_images = image_manifest_state(manifest.get(file), digest)
+        ranges = _page_ranges(path, workers)
+
+        state[file] = {
+            "digest": digest,
+            "known": known,
+            "current_images": current_images,
+            "parts": {},
+            "remaining": len(ranges),
+            "parse_seconds": 0.0,
+            "elapsed_seconds": 0.0
+        }
+        for start, end in ranges:
+            tasks.append((path, file, start, end, known, current_images))
+
+    pending_texts = []
+    pending_parts = []   # (file, chunk count), in pending_texts order
+    vectors = {}         # file -> embedded matrices, in chunk order
+    embed_seconds = 0.0
+
+    def flush():
+        nonlocal embed_seconds
+        if not pending_texts:
+            return
+
+        embed_started = time.perf_counter()
+        matrix = embed(pending_texts)
+        embed_seconds += time.perf_counter() - embed_started
+
+        offset = 0
+        for file, count in pending_parts:
+            vectors.setdefault(file, []).append(matrix[offset:offset + count])
+            offset += count
+
+        pending_texts.clear()
+        pending_parts.clear()
+
+    def collect(result):
+        info = state[result["file"]]
+        info["parts"][result["start"]] = result
+        info["parse_seconds"] += result["seconds"]
+        info["remaining"] -= 1
+        if info["remaining"] > 0:
+            return
+
+        info["elapsed_seconds"] = time.perf_counter() - started
+        info["pages"] = [page for start in sorted(info["parts"]) for page in info["parts"][start]["pages"]]
+        info["chunks"], info["page_spans"] = chunk_pages(info["pages"], count_tokens)
+
+        # Slices keep each embed() call near the batch size, even for huge documents
+        for offset in range(0, len(info["chunks"]), EMBED_BATCH_SIZE):
+            batch = info["chunks"][offset:offset + EMBED_BATCH_SIZE]
+            pending_texts.extend(batch)
+            pending_parts.append((result["file"], len(batch)))
+            if len(pending_texts) >= EMBED_BATCH_SIZE:
+                flush()
+
+    if workers > 1 and len(tasks) > 1:
+        # spawn, not fork: the parent holds torch threads and the embedding model
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=context) as pool:
+            futures = [pool.submit(_parse_task, *task) for task in tasks]
+            for future in as_completed(futures):
+                collect(future.result())
+    else:
+        for task in tasks:
+            collect(_parse_task(*task))
+
+    flush()
+
+    documents = {}
+    timings = {}
+
+    for file, info in state.items():
+        parts = [info["parts"][start] for start in sorted(info["parts"])]
+        pages = info["pages"]
+        matrices = vectors.get(file, [])
+
+        if info["current_images"] is None:
+            record_images(file, info["digest"], info["known"], [i for part in parts for i in part["images"]], manifest)
+
+        documents[file] = {
+            "chunks": info["chunks"],
+            # First page of each chunk; page_spans has the full (first, last) range
+            "pages": [first for first, _ in info["page_spans"]],
+            "page_spans": [list(span) for span in info["page_spans"]],
+            "page_texts": [page["text"] for page in pages],
+            "rule_pages": find_rule_pages([page["text"] for page in pages]),
+            "embeddings": np.concatenate(matrices) if matrices else np.zeros((0, dimension), dtype="float32")
+        }
+        timings[file] = {
+            "pages": len(pages),
+            "chunks": len(documents[file]["chunks"]),
+            "parse_seconds": round(info["parse_seconds"], 3),
+            "elapsed_seconds": round(info["elapsed_seconds"], 3)
+        }
+        print(
+            f"Ingested {file}: {len(pages)} pages, {timings[file]['chunks']} chunks, "
+            f"parse {info['parse_seconds']:.2f}s CPU, ready after {info['elapsed_seconds']:.2f}s"
+        )
+
+    if jobs:
+        print(
+            f"Ingested {len(jobs)} PDFs in {time.perf_counter() - started:.2f}s "
+            f"({len(tasks)} tasks, {workers} workers, embedding {embed_seconds:.2f}s)"
+        )
+
+    return documents, timings
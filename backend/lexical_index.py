@@ -0,0 +1,135 @@
+import re
+from collections import Counter
+
+import numpy as np
+
+# BM25 over the chunks of one role view. Dense MiniLM retrieval is weak on exact
+# tokens such as "RULE 27", valve IDs and part numbers; this index catches them
+# and its ranking is fused with the vector results.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Reciprocal-rank fusion constant; 60 is the usual choice and is not sensitive
+RRF_K = 60
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Identifiers like "V-101" or "PN-12.3A" are also indexed whole
+COMPOUND_PATTERN = re.compile(r"[a-z0-9]+(?:[-./][a-z0-9]+)+")
+RULE_TOKEN_PATTERN = re.compile(r"\brule\s+(\d+)")
+
+
+def tokenize(text):
+    text = text.lower()
+    tokens = WORD_PATTERN.findall(text)
+    tokens += COMPOUND_PATTERN.findall(text)
+    tokens += [f"rule{number}" for number in RULE_TOKEN_PATTERN.findall(text)]
+    return tokens
+
+
+class LexicalIndex:
+    """
+    Compact BM25 inverted index.
+
+    Postings are stored CSR-style: the chunk ids of term t are
+    doc_ids[offsets[t]:offsets[t + 1]]. The matching entries of `weights`
+    already include idf and length normalization, so scoring a query is one
+    vectorized add per query term.
+    """
+
+    def __init__(self, terms, offsets, doc_ids, weights, size):
+        self.vocabulary = {term: position for position, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.size = size
+
+    @classmethod
+    def build(cls, chunks, k1=BM25_K1, b=BM25_B):
+        postings = {}
+        lengths = np.zeros(len(chunks), dtype="float32")
+
+        for chunk_id, chunk in enumerate(chunks):
+            tokens = tokenize(chunk)
+            lengths[chunk_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((chunk_id, tf))
+
+        terms = list(postings)
+        counts = np.fromiter((len(postings[term]) for term in terms), dtype="int64", count=len(terms))
+
+        offsets = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(counts, out=offsets[1:])
+
+        doc_ids = np.empty(offsets[-1], dtype="int32")
+        tfs = np.empty(offsets[-1], dtype="float32")
+        position = 0
+        for term in terms:
+            for chunk_id, tf in postings[term]:
+                doc_ids[position] = chunk_id
+                tfs[position] = tf
+                position += 1
+
+        size = len(chunks)
+        avg_length = float(lengths.mean()) if size and lengths.any() else 1.0
+        norms = k1 * (1 - b + b * lengths / avg_length)
+        idf = np.log1p((size - counts + 0.5) / (counts + 0.5)).astype("float32")
+
+        weights = tfs * (k1 + 1) / (tfs + norms[doc_ids])
+        weights *= np.repeat(idf, counts)
+
+        return cls(terms, offsets, doc_ids, weights.astype("float32"), size)
+
+    def search(self, query, k=5):
+        """
+        Returns:
+            (chunk positions, BM25 scores), best match first; chunks sharing no term are left out
+        """
+        scores = np.zeros(self.size, dtype="float32")
+
+        for term in set(tokenize(query)):
+            position = self.vocabulary.get(term)
+            if position is None:
+                continue
+            start, end = self.offsets[position], self.offsets[position + 1]
+            # A term lists each chunk once, so plain fancy-index add is safe
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return candidates.tolist(), scores[candidates].tolist()
+
+    def state(self):
+        """(terms, arrays) for persisting next to the FAISS index."""
+        terms = [None] * len(self.vocabulary)
+        for term, position in self.vocabulary.items():
+            terms[position] = term
+
+        arrays = {
+            "offsets": self.offsets,
+            "doc_ids": self.doc_ids,
+            "weights": self.weights,
+            "size": np.array([self.size], dtype="int64"),
+        }
+        return terms, arrays
+
+    @classmethod
+    def from_state(cls, terms, arrays):
+        return cls(terms, arrays["offsets"], arrays["doc_ids"], arrays["weights"], int(arrays["size"][0]))
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Fuse several rankings of chunk positions.
+
+    Returns:
+        dict mapping chunk position -> fused score, highest first
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+
+    return dict(sorted(fused.items(), key=lambda item: -item[1]))
@@ -2,25 +2,36 @@ from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from fastapi.security import OAuth2PasswordBearer
-from db import init_db, create_user, get_user
+from db import init_db, insert_user, find_user, update_password_hash, hash_password, check_password, password_pool
 from fastapi import UploadFile, File, Form
 import shutil
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
 from jose import JWTError, jwt
-from db import save_chat, get_recent_chats
+from db import save_chat, get_recent_chats, flush_chats
+from session_store import create_session_store
 import sqlite3
 from db import get_recent_chats
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 import ollama
 import re
+import json
+import asyncio
 
 
-from rag_engine import load_all_pdfs, create_index, ask_question, interpret_image_with_vision, highlight_diagram_elements, analyze_blueprint_component
+from answer_cache import get_cached_answer, put_cached_answer, invalidate_answers, answer_cache_stats
+from index_store import generation_lock, read_current_generation, claim_exclusive
+from rag_engine import embedder, Corpus, load_corpus, load_document, ask_question_async, retrieve_async, build_messages, history_digest, stream_answer, interpret_image_with_vision, highlight_diagram_elements, analyze_blueprint_component, interpret_images, precompute_image_descriptions
 
-# Session storage for tracking user's last shown images
-user_image_sessions: Dict[str, List[str]] = {}
+# Session storage for tracking user's last shown images. Bounded (LRU/TTL) and,
+# with the default SQLite backend, shared by every worker process on the host.
+image_sessions = create_session_store()
 
 
 app = FastAPI()
@@ -56,7 +67,24 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Every authenticated request decodes and verifies the same token again, so
+# verified tokens are remembered briefly (never past their own expiry)
+TOKEN_CACHE_TTL = float(os.environ.get("RAG_TOKEN_CACHE_TTL", "60"))
+TOKEN_CACHE_MAX_ENTRIES = 10000
+
+token_cache: "OrderedDict[str, tuple]" = OrderedDict()   # token -> (user, valid until)
+token_cache_lock = threading.Lock()
+
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
+    now = time.time()
+
+    with token_cache_lock:
+        cached = token_cache.get(token)
+        if cached and cached[1] > now:
+            token_cache.move_to_end(token)
+            return dict(cached[0])
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -68,10 +96,19 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         role: str = payload.get("role")
         if username is None or role is None:
             raise credentials_exception
-        return {"username": username, "role": role}
+        user = {"username": username, "role": role}
     except JWTError:
         raise credentials_exception
 
+    valid_until = min(now + TOKEN_CACHE_TTL, payload.get("exp", now))
+    with token_cache_lock:
+        token_cache[token] = (user, valid_until)
+        token_cache.move_to_end(token)
+        while len(token_cache) > TOKEN_CACHE_MAX_ENTRIES:
+            token_cache.popitem(last=False)
+
+    return dict(user)
+
 
 init_db()
 
@@ -113,32 +150,115 @@ def detect_image_analysis_request(question: str) -> bool:
 
 def get_latest_images_for_user(username: str) -> List[str]:
     """Get the most recently shown images for a user"""
-    return user_image_sessions.get(username, [])
+    return image_sessions.get_images(username)
 
 
 def store_images_for_user(username: str, images: List[str]):
     """Store shown images in user session, keep last 5"""
     if images:
-        if username not in user_image_sessions:
-            user_image_sessions[username] = []
-        user_image_sessions[username] = images + user_image_sessions.get(username, [])
-        # Keep only last 5 images
-        user_image_sessions[username] = user_image_sessions[username][:5]
+        image_sessions.store_images(username, images)
 
 
 # ---------- LOAD RAG SYSTEM ON START ----------
 
 
-chunks, chunk_roles, chunk_sources, chunk_pages = load_all_pdfs("../documents")
+# Unchanged PDFs are served from the on-disk embedding store (index_cache/).
+# The corpus holds one prebuilt index per role (plus ADMIN over everything)
+# so /ask never re-embeds documents. Its indexes, chunk texts and sources are
+# memory-mapped from a published generation, so every uvicorn worker shares
+# them. Uploads publish a new generation; the other workers poll for it.
+corpus = load_corpus("../documents")
+
+# Serialises uploads and snapshot swaps in this worker; readers never take it,
+# they just grab the current snapshot
+ingest_lock = threading.Lock()
 
+GENERATION_POLL_SECONDS = float(os.environ.get("RAG_GENERATION_POLL_SECONDS", "1.0"))
 
 
-print("Chunks loaded:", len(chunks))
 
-if len(chunks) == 0:
+print("Chunks loaded:", corpus.count_chunks())
+
+if corpus.count_chunks() == 0:
     raise Exception("No PDFs found in documents folder")
 
-index = create_index(chunks)
+# Optionally describe every image once in the background so /ask can reuse it
+PRECOMPUTE_IMAGE_DESCRIPTIONS = os.environ.get("RAG_PRECOMPUTE_IMAGE_DESCRIPTIONS", "0") == "1"
+precompute_tasks = set()
+
+
+def start_image_precompute(image_names):
+    """Must be called from the event loop; runs behind the shared vision concurrency limit."""
+    if PRECOMPUTE_IMAGE_DESCRIPTIONS and image_names:
+        task = asyncio.ensure_future(precompute_image_descriptions(image_names))
+        precompute_tasks.add(task)
+        task.add_done_callback(precompute_tasks.discard)
+        return task
+    return None
+
+
+@app.on_event("startup")
+async def warm_image_descriptions():
+    if not PRECOMPUTE_IMAGE_DESCRIPTIONS:
+        return
+
+    # Every worker starts with the same images; one describes them and the
+    # others read the answers from the shared vision cache
+    claim = claim_exclusive("image-precompute")
+    if claim is None:
+        print("Another worker is precomputing image descriptions")
+        return
+
+    task = start_image_precompute([name for names in corpus.page_images.values() for name in names])
+    if task is None:
+        claim.close()
+    else:
+        task.add_done_callback(lambda _: claim.close())
+
+
+def refresh_corpus():
+    """Swap to the CURRENT generation if another worker published a newer one."""
+    global corpus
+
+    current = read_current_generation()
+    if current is None or current["generation"] <= corpus.version:
+        return None
+
+    snapshot = Corpus.open(current["generation"])
+
+    with ingest_lock:
+        # An upload in this worker may have swapped in something newer meanwhile
+        if snapshot.version <= corpus.version:
+            return None
+        corpus = snapshot
+
+    return snapshot
+
+
+async def follow_generations():
+    while True:
+        await asyncio.sleep(GENERATION_POLL_SECONDS)
+        try:
+            snapshot = await run_in_threadpool(refresh_corpus)
+        except Exception as e:
+            print(f"Could not open the current corpus generation: {e}")
+            continue
+
+        if snapshot is not None:
+            print(f"Switched to corpus generation {snapshot.version}")
+            invalidate_answers(snapshot.version)
+
+
+@app.on_event("startup")
+async def watch_corpus_generations():
+    app.state.generation_watcher = asyncio.ensure_future(follow_generations())
+
+
+@app.on_event("shutdown")
+async def flush_chat_log():
+    # Chat turns are written behind the request; commit what is still queued
+    if not await run_in_threadpool(flush_chats, 10):
+        print("Timed out flushing queued chat history")
 
 
 
@@ -153,121 +273,106 @@ class AskRequest(BaseModel):
     question: str
     role: str
     last_image: Optional[str] = None  # ⭐ NEW: Track the last shown image
-def ask(req: AskRequest, current_user: dict = Depends(get_current_user)):
-    username = current_user.get("username")
-    user_role = current_user.get("role")
-    role_to_query = req.role if user_role in ["ADMIN", "CAPTAIN"] else user_role
-    
-    # ========== CHECK IF USER IS ASKING ABOUT A SPECIFIC IMAGE ==========
+
+
+def empty_answer(message: str):
+    return {
+        "answer": message,
+        "source": [],
+        "images": [],
+        "image_details": [],
+        "matches": [],
+        "analysis_type": "document_query"
+    }
+
+
+def describe_matches(role_index, matched_indices, scores):
+    """Retrieved chunks with their cosine similarity (and BM25/RRF scores), best first, so clients can threshold them."""
+    return [
+        {
+            "source": role_index["sources"][i],
+            "page": int(role_index["pages"][i]),
+            "page_end": int(role_index["page_spans"][i][1]),
+            **{name: round(value, 4) if value is not None else None for name, value in score.items()}
+        }
+        for i, score in zip(matched_indices, scores)
+    ]
+
+
+async def resolve_image_to_analyze(req: AskRequest, username: str) -> Optional[str]:
+    """Return the image the user is asking about, if any and it exists on disk."""
     # Priority 1: Use last_image from request if provided
     image_name_to_analyze = req.last_image if req.last_image else None
     
     # Priority 2: Detect image query and use server-side session
     if not image_name_to_analyze:
         is_image_query = detect_image_analysis_request(req.question)
-        latest_images = get_latest_images_for_user(username)
+        # The session store is SQLite; only read it for image follow-ups, off the event loop
+        latest_images = await run_in_threadpool(get_latest_images_for_user, username) if is_image_query else []
         
-        if is_image_query and latest_images:
+        if latest_images:
             image_name_to_analyze = latest_images[0]
     
-    # If we have an image to analyze, use it
-    if image_name_to_analyze:
-        image_path = os.path.join("extracted_images", image_name_to_analyze)
-        
-        if os.path.exists(image_path):
-            # Analyze the specific image the user was asking about
-            image_analysis = highlight_diagram_elements(image_path, req.question)
-            
-            # Also get related document context
-            filtered_chunks = []
-            filtered_sources = []
-            filtered_pages = []
-            
-            for chunk, r, src, page in zip(chunks, chunk_roles, chunk_sources, chunk_pages):
-                if r == role_to_query or role_to_query == "ADMIN":
-                    filtered_chunks.append(chunk)
-                    filtered_sources.append(src)
-                    filtered_pages.append(page)
-            
-            save_chat(username, req.question, image_analysis.get("interpretation", ""))
-            
-            return {
-                "answer": image_analysis.get("interpretation", ""),
-                "source": list(set(filtered_sources)),
-                "images": [image_name_to_analyze],
-                "image_details": [{
-                    "image": image_name_to_analyze,
-                    "interpretation": image_analysis.get("interpretation", ""),
-                    "highlighted_image": image_analysis.get("highlighted_image"),
-                    "analysis_info": image_analysis.get("analysis_info")
-                }],
-                "analysis_type": "image_analysis"
-            }
-    
-    # ========== NORMAL DOCUMENT QUERY ==========
-    filtered_chunks = []
-    filtered_sources = []
-    filtered_pages = []
+    if image_name_to_analyze and os.path.exists(os.path.join("extracted_images", image_name_to_analyze)):
+        return image_name_to_analyze
+    return None
 
-    for chunk, r, src, page in zip(chunks, chunk_roles, chunk_sources, chunk_pages):
-        if r == role_to_query or role_to_query == "ADMIN":
-            filtered_chunks.append(chunk)
-            filtered_sources.append(src)
-            filtered_pages.append(page)
 
-    print("MATCHED:", list(zip(filtered_sources[:5], filtered_pages[:5])))
-    temp_index = create_index(filtered_chunks)
-
-    # 🧠 MEMORY PART STARTS HERE
-    history = get_recent_chats(username, limit=5)
+async def analyze_image_question(req: AskRequest, username: str, role_to_query: str, image_name: str):
+    image_path = os.path.join("extracted_images", image_name)
+    
+    # Analyze the specific image the user was asking about
+    image_analysis = await highlight_diagram_elements(image_path, req.question)
+    
+    # Also get related document context
+    role_index = corpus.role_indexes.get(role_to_query)
+    filtered_sources = role_index["source_names"] if role_index else []
+    
+    save_chat(username, req.question, image_analysis.get("interpretation", ""))
+    
+    return {
+        "answer": image_analysis.get("interpretation", ""),
+        "source": list(filtered_sources),
+        "images": [image_name],
+        "image_details": [{
+            "image": image_name,
+            "interpretation": image_analysis.get("interpretation", ""),
+            "highlighted_image": image_analysis.get("highlighted_image"),
+            "analysis_info": image_analysis.get("analysis_info")
+        }],
+        "analysis_type": "image_analysis"
+    }
 
-    # Get answer AND the indices of matched chunks
-    answer, matched_indices = ask_question(
-        req.question,
-        temp_index,
-        filtered_chunks,
-        history,
-        return_indices=True
-    )
 
-    save_chat(username, req.question, answer)
-    # 🧠 MEMORY PART ENDS HERE
-    
+def find_related_images(snapshot, role_index, matched_indices, question: str, answer: str) -> List[str]:
     # Extract pages and sources from the MATCHED chunks (not all filtered chunks)
     relevant_pages = []
     relevant_sources = []
     
+    # A chunk can run across pages, so every page it spans is relevant
     for idx in matched_indices:
-        relevant_pages.append(filtered_pages[idx])
-        relevant_sources.append(filtered_sources[idx])
-    
-    # Get images from the relevant pages only
-    candidate_images = []
+        first_page, last_page = (int(page) for page in role_index["page_spans"][idx])
+        for page in range(first_page, last_page + 1):
+            relevant_pages.append(page)
+            relevant_sources.append(role_index["sources"][idx])
     
-    # Build prefixes from the actual matched chunk pages
-    image_prefixes = set()
-    for src, page in zip(relevant_sources, relevant_pages):
-        prefix = f"{src}_page{page}_"
-        image_prefixes.add(prefix)
+    # Get images from the relevant pages only, via the (source, page) -> images
+    # index kept on the corpus snapshot. No directory scan or filename prefixes.
+    candidate_images = []   # (image, (source, page)), first match order, no duplicates
+    seen_images = set()
     
-    # Get all available images
-    if os.path.exists("extracted_images"):
-        for img in os.listdir("extracted_images"):
-            # Check if image starts with any of the relevant prefixes
-            for prefix in image_prefixes:
-                if img.startswith(prefix):
-                    candidate_images.append(img)
-                    break
-    
-    # Remove duplicates
-    candidate_images = list(set(candidate_images))
+    for location in zip(relevant_sources, relevant_pages):
+        for img in snapshot.page_images.get(location, []):
+            if img not in seen_images:
+                seen_images.add(img)
+                candidate_images.append((img, location))
     
     # Extract rule/section references from the question and answer
     # Extract RULE numbers mentioned in the question (e.g., "RULE 25", "RULE 27")
     rule_references = set()
     
     # Search in question
-    rule_matches = re.findall(r'RULE\s+(\d+)', req.question, re.IGNORECASE)
+    rule_matches = re.findall(r'RULE\s+(\d+)', question, re.IGNORECASE)
     rule_references.update(rule_matches)
     
     # Search in answer
@@ -282,77 +387,169 @@ def ask(req: AskRequest, current_user: dict = Depends(get_current_user)):
     
     # If we found specific rule references, use them to filter images
     if rule_references and candidate_images:
-        # Get the PDF text for the pages to check which rules are on those pages
-        from rag_engine import load_pdf_text
-        
-        for img in candidate_images:
-            # Extract source PDF and page number from image filename
-            # Format: PDF_name_pageN_index.ext
-            parts = img.rsplit('_', 2)
-            if len(parts) >= 3:
-                page_num = parts[1].replace('page', '')
-                try:
-                    page_num = int(page_num)
-                    
-                    # Find which PDF this image belongs to
-                    pdf_source = None
-                    for src in set(filtered_sources):
-                        if src in img:
-                            pdf_source = src
-                            break
-                    
-                    if pdf_source:
-                        # Load the PDF and get text from that page
-                        pdf_path = os.path.join("../documents", pdf_source)
-                        if os.path.exists(pdf_path):
-                            from pypdf import PdfReader
-                            reader = PdfReader(pdf_path)
-                            if page_num < len(reader.pages):
-                                page_text = reader.pages[page_num].extract_text()
-                                
-                                # Check if any of the referenced rules are in this page
-                                for rule_ref in rule_references:
-                                    if re.search(rf'RULE\s+{rule_ref}(?:\s|[^0-9]|$)', page_text, re.IGNORECASE):
-                                        related_images.append(img)
-                                        break
-                except:
-                    # If extraction fails, include the image (better to have it than not)
-                    related_images.append(img)
+        # RULE -> (source, page) inverted index built at ingest: a dict lookup, no PDF text
+        rule_locations = snapshot.pages_for_rules(rule_references)
+        related_images = [img for img, location in candidate_images if location in rule_locations]
     
     # Fallback: if no images were matched by rule reference, include all candidates
     if not related_images and candidate_images:
-        related_images = candidate_images
+        related_images = [img for img, _ in candidate_images]
+
+    return related_images
+
+
+def role_for_request(req: AskRequest, current_user: dict) -> str:
+    user_role = current_user.get("role")
+    return req.role if user_role in ["ADMIN", "CAPTAIN"] else user_role
+
+
+@app.post("/ask")
+async def ask(req: AskRequest, current_user: dict = Depends(get_current_user)):
+    username = current_user.get("username")
+    role_to_query = role_for_request(req, current_user)
+    
+    # ========== CHECK IF USER IS ASKING ABOUT A SPECIFIC IMAGE ==========
+    image_name_to_analyze = await resolve_image_to_analyze(req, username)
+    
+    if image_name_to_analyze:
+        return await analyze_image_question(req, username, role_to_query, image_name_to_analyze)
+    
+    # ========== NORMAL DOCUMENT QUERY ==========
+    snapshot = corpus
+    role_index = snapshot.role_indexes.get(role_to_query)
+
+    if role_index is None:
+        return empty_answer("No documents are available for this role.")
+
+    # 🧠 MEMORY PART STARTS HERE
+    history = await run_in_threadpool(get_recent_chats, username, 5)
+
+    # Get answer AND the indices of matched chunks
+    answer, matched_indices, scores, timings = await ask_question_async(
+        req.question,
+        role_index["index"],
+        role_index["chunks"],
+        history,
+        cache_scope=(role_to_query, snapshot.version),
+        lexical=role_index["lexical"]
+    )
+
+    # Queued for the background writer; the next get_recent_chats still sees it
+    save_chat(username, req.question, answer)
+    # 🧠 MEMORY PART ENDS HERE
     
-    # Interpret images with LLaVA vision model
-    image_interpretations = []
-    if related_images:
-        for img in related_images:
-            img_path = os.path.join("extracted_images", img)
-            if os.path.exists(img_path):
-                print(f"Interpreting image: {img}")
-                interpretation = interpret_image_with_vision(img_path, req.question)
-                image_interpretations.append({
-                    "image": img,
-                    "interpretation": interpretation
-                })
+    related_images = find_related_images(snapshot, role_index, matched_indices, req.question, answer)
+    
+    # Interpret images with LLaVA vision model, concurrently and with a deadline
+    image_interpretations = await interpret_images(related_images, req.question) if related_images else []
     
     # Store shown images in user session for future reference
-    store_images_for_user(username, related_images)
+    await run_in_threadpool(store_images_for_user, username, related_images)
 
     return {
         "answer": answer,
-        "source": list(set(filtered_sources)),
+        "source": list(role_index["source_names"]),
         "images": related_images,
         "image_details": image_interpretations,
+        "matches": describe_matches(role_index, matched_indices, scores),
+        "timings": timings,
         "analysis_type": "document_query"
     }
 
 
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Streaming variant of /ask. Emits newline-delimited JSON events:
+    "sources" (retrieval results) first, then one "token" per generated
+    piece of the answer, then "images" with image details, then "done".
+    """
+    username = current_user.get("username")
+    role_to_query = role_for_request(req, current_user)
+
+    async def events():
+        image_name_to_analyze = await resolve_image_to_analyze(req, username)
+
+        if image_name_to_analyze:
+            result = await analyze_image_question(req, username, role_to_query, image_name_to_analyze)
+            yield {"type": "sources", "source": result["source"], "matches": []}
+            yield {"type": "token", "content": result["answer"]}
+            yield {"type": "images", "images": result["images"], "image_details": result["image_details"], "analysis_type": result["analysis_type"]}
+            return
+
+        snapshot = corpus
+        role_index = snapshot.role_indexes.get(role_to_query)
+
+        if role_index is None:
+            yield {"type": "sources", "source": [], "matches": []}
+            yield {"type": "token", "content": "No documents are available for this role."}
+            yield {"type": "images", "images": [], "image_details": [], "analysis_type": "document_query"}
+            return
+
+        history = await run_in_threadpool(get_recent_chats, username, 5)
+        matched_indices, scores, q_embedding, timings = await retrieve_async(
+            req.question, role_index["index"], lexical=role_index["lexical"], chunks=role_index["chunks"]
+        )
+
+        yield {
+            "type": "sources",
+            "source": list(role_index["source_names"]),
+            "matches": describe_matches(role_index, matched_indices, scores),
+            "timings": timings
+        }
+
+        digest = history_digest(history)
+        answer = get_cached_answer(role_to_query, snapshot.version, matched_indices, q_embedding, digest)
+
+        if answer is not None:
+            yield {"type": "token", "content": answer}
+        else:
+            messages = build_messages(req.question, [role_index["chunks"][i] for i in matched_indices], history)
+
+            answer = ""
+            async for token in stream_answer(messages):
+                answer += token
+                yield {"type": "token", "content": token}
+
+            put_cached_answer(role_to_query, snapshot.version, matched_indices, q_embedding, answer, digest)
+
+        save_chat(username, req.question, answer)
+
+        related_images = find_related_images(snapshot, role_index, matched_indices, req.question, answer)
+        image_interpretations = await interpret_images(related_images, req.question) if related_images else []
+        await run_in_threadpool(store_images_for_user, username, related_images)
+
+        yield {"type": "images", "images": related_images, "image_details": image_interpretations, "analysis_type": "document_query"}
+
+    async def ndjson():
+        try:
+            async for event in events():
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            print(f"Error streaming answer: {e}")
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+            return
+        yield json.dumps({"type": "done"}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.get("/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    return {
+        "embedding": embedder.stats(),
+        "answer_cache": answer_cache_stats(),
+        "passwords": password_pool.stats(),
+        "logins": login_stats,
+        "token_cache_entries": len(token_cache)
+    }
+
+
 @app.get("/history")
-def get_history(current_user: dict = Depends(get_current_user)):
+async def get_history(current_user: dict = Depends(get_current_user)):
     username = current_user.get("username")
 
-    chats = get_recent_chats(username, limit=20)
+    chats = await run_in_threadpool(get_recent_chats, username, 20)
 
     return {
         "history": [
@@ -374,39 +571,85 @@ async def upload_pdf(
     if current_user.get("role") != role and current_user.get("role") != "ADMIN":
         raise HTTPException(status_code=403, detail="Not authorized to upload for this role")
 
-    save_path = f"../documents/{role.upper()}_{file.filename}"
+    file_name = f"{role.upper()}_{os.path.basename(file.filename)}"
+
+    document, timings = await run_in_threadpool(ingest_upload, file.file, file_name)
+    start_image_precompute([name for names in document["page_images"].values() for name in names])
+
+    return {"message": "File uploaded and indexed successfully", "timings": timings}
+
+
+def ingest_upload(source_file, file_name):
+    """
+    Index only the uploaded PDF and publish a new corpus generation.
+    A re-upload of an existing file replaces its old vectors.
+    """
+    global corpus
+
+    save_path = os.path.join("../documents", file_name)
+    tmp_path = save_path + ".part"
 
-    with open(save_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # The generation lock also serialises uploads handled by other workers
+    with ingest_lock, generation_lock():
+        with open(tmp_path, "wb") as buffer:
+            shutil.copyfileobj(source_file, buffer)
+        os.replace(tmp_path, save_path)
 
-    # Reload PDFs
-    global chunks, chunk_roles, chunk_sources, chunk_pages
-    chunks, chunk_roles, chunk_sources, chunk_pages = load_all_pdfs("../documents")
+        # Build on the newest generation, which another worker may have published
+        base = corpus
+        current = read_current_generation()
+        if current is not None and current["generation"] > corpus.version:
+            base = Corpus.open(current["generation"])
 
-    return {"message": "File uploaded and indexed successfully"}
+        document, timings = load_document("../documents", file_name)
+        generation = base.with_document(document).save()
+        new_corpus = Corpus.open(generation)
 
+        # Single reference swap: requests see either the old or the new snapshot
+        corpus = new_corpus
 
+    # Answers are keyed by corpus version; free the ones no request can hit any more
+    invalidate_answers(new_corpus.version)
 
+    return document, timings
 
 
 
 
+
+
+
+login_stats = {"succeeded": 0, "failed": 0}
+
+
 @app.post("/signup")
-def signup(req: SignupRequest):
+async def signup(req: SignupRequest):
     try:
-        create_user(req.username, req.password, req.role)
+        # bcrypt is deliberately slow; it runs on its own bounded pool, not the event loop or request threads
+        hashed = await asyncio.wrap_future(hash_password(req.password))
+        await run_in_threadpool(insert_user, req.username, hashed, req.role)
         return {"message": "User created"}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/login")
-def login(user: LoginRequest):
-    db_user = get_user(user.username, user.password)
-
-    if not db_user:
+async def login(user: LoginRequest):
+    db_user = await run_in_threadpool(find_user, user.username)
+    matches = False
+
+    if db_user:
+        matches, new_hash = await asyncio.wrap_future(check_password(user.password, db_user[2]))
+        if matches and new_hash:
+            # Plaintext or below the current bcrypt cost: store the upgraded hash
+            await run_in_threadpool(update_password_hash, user.username, new_hash)
+
+    if not matches:
+        login_stats["failed"] += 1
         return {"error": "Invalid credentials"}
 
+    login_stats["succeeded"] += 1
+
     username = db_user[1]
     role = db_user[3]
 
@@ -432,7 +675,7 @@ class ComponentAnalysisRequest(BaseModel):
 
 
 @app.post("/analyze-diagram")
-def analyze_diagram_with_highlighting(
+async def analyze_diagram_with_highlighting(
     req: DiagramAnalysisRequest,
     current_user: dict = Depends(get_current_user)
 ):
@@ -445,12 +688,12 @@ def analyze_diagram_with_highlighting(
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail="Image not found")
     
-    result = highlight_diagram_elements(image_path, req.question)
+    result = await highlight_diagram_elements(image_path, req.question)
     return result
 
 
 @app.post("/analyze-component")
-def analyze_blueprint_component_endpoint(
+async def analyze_blueprint_component_endpoint(
     req: ComponentAnalysisRequest,
     current_user: dict = Depends(get_current_user)
 ):
@@ -463,7 +706,7 @@ def analyze_blueprint_component_endpoint(
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail="Image not found")
     
-    analysis = analyze_blueprint_component(image_path, req.component_name)
+    analysis = await analyze_blueprint_component(image_path, req.component_name)
     return {
         "component": req.component_name,
         "image": req.image_name,
@@ -472,7 +715,7 @@ def analyze_blueprint_component_endpoint(
 
 
 @app.post("/interpret-image-detailed")
-def interpret_image_detailed(
+async def interpret_image_detailed(
     req: DiagramAnalysisRequest,
     current_user: dict = Depends(get_current_user)
 ):
@@ -485,7 +728,7 @@ def interpret_image_detailed(
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail="Image not found")
     
-    interpretation = interpret_image_with_vision(image_path, req.question)
+    interpretation = await interpret_image_with_vision(image_path, req.question)
     return {
         "image": req.image_name,
         "question": req.question,
@@ -0,0 +1,240 @@
+import hashlib
+import os
+import re
+
+import fitz
+
+from index_store import file_digest, load_image_manifest, save_image_manifest
+
+# Document parsing stage. Kept free of the embedding model so it can also be
+# used from ingest worker processes.
+IMAGE_DIR = "extracted_images"
+
+RULE_PATTERN = re.compile(r'RULE\s+(\d+)', re.IGNORECASE)
+
+
+def image_manifest_state(entry, digest):
+    """
+    Returns:
+        (known, current_images): image name -> sha1 from the manifest, and
+        page -> image names if the manifest is already current for this PDF
+        (otherwise None, meaning images must be decoded)
+    """
+    if entry is None:
+        return {}, None
+
+    known = {i["name"]: i["sha1"] for i in entry["images"]}
+
+    if entry["digest"] != digest or not all(
+        os.path.exists(os.path.join(IMAGE_DIR, name)) for name in known
+    ):
+        return known, None
+
+    current_images = {}
+    for image in entry["images"]:
+        current_images.setdefault(image["page"], []).append(image["name"])
+
+    return known, current_images
+
+
+def _image_unchanged(img_path, sha1, known_sha1):
+    if not os.path.exists(img_path):
+        return False
+    if known_sha1 is not None:
+        return known_sha1 == sha1
+    # No manifest entry yet (e.g. images already on disk from an older run)
+    with open(img_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest() == sha1
+
+
+def _write_image(img_path, image_bytes, same_as=None):
+    """Write via a temp file; duplicates are hard-linked to the first copy when possible."""
+    tmp_path = img_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    try:
+        if same_as is None:
+            raise OSError
+        os.link(same_as, tmp_path)
+    except OSError:
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+
+    os.replace(tmp_path, img_path)
+
+
+def _remove_image(name):
+    path = os.path.join(IMAGE_DIR, name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# ----------- PARSE PDF -----------
+def parse_page_range(pdf_path, pdf_name, start=0, end=None, known=None, current_images=None, with_text=True):
+    """
+    Parse pages [start, end) of a PDF in a single PyMuPDF pass, yielding page
+    text, extracted images and page metadata together. Safe to run in a worker
+    process: image files are written here, the manifest is left to the caller.
+
+    Images are written to IMAGE_DIR as {pdf_name}_page{N}_{i}.{ext}. Unchanged
+    images (per the manifest's sha1) are never rewritten, each xref is decoded
+    once, and images repeated across pages are hard-linked to a single copy.
+
+    Args:
+        known: image name -> sha1 from the manifest
+        current_images: page -> image names when the manifest is current,
+                        in which case no image is decoded at all
+
+    Returns:
+        (pages, images): {"page", "text", "images", "width", "height"} per page,
+        and manifest entries for every image in the range
+    """
+    known = known or {}
+    decoded = {}   # xref -> (bytes, ext, sha1)
+    written = {}   # sha1 -> first path holding that content
+    images = []
+    pages = []
+
+    doc = fitz.open(pdf_path)
+    end = len(doc) if end is None else min(end, len(doc))
+
+    for page_index in range(start, end):
+        page = doc[page_index]
+        page_images = []
+
+        if current_images is not None:
+            page_images = current_images.get(page_index, [])
+        else:
+            for img_index, img in enumerate(page.get_images(full=True)):
+                xref = img[0]
+                if xref not in decoded:
+                    base_image = doc.extract_image(xref)
+                    image_bytes = base_image["image"]
+                    decoded[xref] = (image_bytes, base_image["ext"], hashlib.sha1(image_bytes).hexdigest())
+                image_bytes, ext, sha1 = decoded[xref]
+
+                img_name = f"{pdf_name}_page{page_index}_{img_index}.{ext}"
+                img_path = os.path.join(IMAGE_DIR, img_name)
+
+                if not _image_unchanged(img_path, sha1, known.get(img_name)):
+                    _write_image(img_path, image_bytes, written.get(sha1))
+                written.setdefault(sha1, img_path)
+
+                page_images.append(img_name)
+                images.append({
+                    "page": page_index,
+                    "index": img_index,
+                    "xref": xref,
+                    "name": img_name,
+                    "sha1": sha1
+                })
+
+        pages.append({
+            "page": page_index,
+            "text": page.get_text() if with_text else "",
+            "images": page_images,
+            "width": page.rect.width,
+            "height": page.rect.height
+        })
+
+    doc.close()
+
+    return pages, images
+
+
+def count_pages(pdf_path):
+    doc = fitz.open(pdf_path)
+    count = len(doc)
+    doc.close()
+    return count
+
+
+def record_images(pdf_name, digest, known, images, manifest=None):
+    """Store a PDF's freshly extracted images in the manifest and drop its stale files."""
+    manifest = load_image_manifest() if manifest is None else manifest
+
+    # Images the previous version of this PDF had but the new one does not
+    current_names = {i["name"] for i in images}
+    for name in set(known) - current_names:
+        _remove_image(name)
+
+    manifest[pdf_name] = {"digest": digest, "images": images}
+    save_image_manifest(manifest)
+
+
+def parse_pdf(pdf_path, pdf_name, digest=None, with_text=True):
+    """
+    Parse a whole PDF in one pass and keep the image manifest up to date.
+
+    Returns:
+        list of {"page", "text", "images", "width", "height"} per page
+    """
+    digest = digest or file_digest(pdf_path)
+    manifest = load_image_manifest()
+    known, current_images = image_manifest_state(manifest.get(pdf_name), digest)
+
+    pages, images = parse_page_range(
+        pdf_path, pdf_name, known=known, current_images=current_images, with_text=with_text
+    )
+
+    if current_images is None:
+        record_images(pdf_name, digest, known, images, manifest)
+
+    return pages
+
+
+def extract_images_from_pdf(pdf_path, pdf_name, digest=None):
+    """
+    Make sure a PDF's images are extracted; skips PyMuPDF entirely if the manifest is current.
+
+    Returns:
+        dict mapping page number -> image names on that page
+    """
+    digest = digest or file_digest(pdf_path)
+    known, current_images = image_manifest_state(load_image_manifest().get(pdf_name), digest)
+
+    if current_images is not None:
+        return current_images
+
+    pages = parse_pdf(pdf_path, pdf_name, digest, with_text=False)
+    return {page["page"]: page["images"] for page in pages if page["images"]}
+
+
+def prune_extracted_images(pdf_names):
+    """Delete extracted images of PDFs that are no longer in the documents folder."""
+    manifest = load_image_manifest()
+    stale = set(manifest) - set(pdf_names)
+
+    if not stale:
+        return
+
+    for pdf_name in stale:
+        for image in manifest.pop(pdf_name)["images"]:
+            _remove_image(image["name"])
+
+    save_image_manifest(manifest)
+
+
+def load_pdf_text(pdf_path):
+    doc = fitz.open(pdf_path)
+    text = "".join(page.get_text() for page in doc)
+    doc.close()
+
+    return text
+
+
+def find_rule_pages(page_texts):
+    """
+    Inverted index of "RULE N" mentions for one document.
+
+    Returns:
+        dict mapping rule number (as a string) -> sorted page numbers
+    """
+    rule_pages = {}
+
+    for page_num, text in enumerate(page_texts):
+        for rule in set(RULE_PATTERN.findall(text)):
+            rule_pages.setdefault(rule, []).append(page_num)
+
+    return rule_pages
@@ -1,145 +1,509 @@
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import SentenceTransformer, CrossEncoder
 import faiss
-from pypdf import PdfReader
 import ollama
-import fitz
 import os
 import cv2
 from PIL import Image, ImageDraw, ImageFont
 import base64
 from io import BytesIO
 import json
+from index_store import (
+    file_digest, corpus_key, load_cached_document, save_cached_document, prune_cached_documents,
+    generation_lock, read_current_generation, write_generation, open_generation
+)
+from pdf_parser import IMAGE_DIR, extract_images_from_pdf, prune_extracted_images, load_pdf_text, find_rule_pages
+from chunker import split_text
+from vision_cache import normalize_prompt, get_cached_response, put_cached_response
+from answer_cache import get_cached_answer, put_cached_answer
+import hashlib
+import asyncio
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from ingest import ingest_pdfs
+from ann_index import create_ann_index, apply_search_params, index_signature, is_ivf_index
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
 
 print("Loading embedding model...")
 model = SentenceTransformer('all-MiniLM-L6-v2')
 
 
 # ----------- READ PDF -----------
-import os
+def load_documents(folder, files, digests=None):
+    """
+    Load the given PDFs, reusing the on-disk store entry of every document
+    whose content hash is unchanged. The rest go through the parallel ingest
+    pipeline, which opens each PDF once for text and images.
 
-def load_pdf_text(pdf_path):
-    reader = PdfReader(pdf_path)
-    text = ""
+    Args:
+        digests: optional filename -> content digest the caller already computed
 
-    for page in reader.pages:
-        content = page.extract_text()
-        if content:
-            text += content
+    Returns:
+        (documents, timings): filename -> dict with "source", "role", "digest",
+        "chunks", "pages", "page_spans", "page_texts", "rule_pages", "page_images", "embeddings";
+        and per-document ingest timings
+    """
+    documents = {}
+    digests = dict(digests or {})
+    jobs = []
 
-    return text
+    for file in files:
+        if file not in digests:
+            digests[file] = file_digest(os.path.join(folder, file))
+        digest = digests[file]
+        document = load_cached_document(digest)
 
+        if document is None:
+            jobs.append((file, digest))
+        elif "rule_pages" not in document:
+            document["rule_pages"] = find_rule_pages(document["page_texts"])
 
+        documents[file] = document
 
+    parsed, timings = ingest_pdfs(
+        folder, jobs, embedder.encode, model.get_sentence_embedding_dimension(), count_tokens
+    )
 
+    for file, digest in jobs:
+        save_cached_document(digest, parsed[file])
+        # Re-open from the store so the embeddings are memory-mapped, not held in RAM
+        documents[file] = load_cached_document(digest) or parsed[file]
 
+    for file, document in documents.items():
+        document["source"] = file
+        document["role"] = file.split("_")[0].upper()
+        document["digest"] = digests[file]
+        # Image names depend on the filename, so they come from the manifest rather
+        # than the content-keyed store. A current manifest means the PDF is not opened.
+        document["page_images"] = extract_images_from_pdf(os.path.join(folder, file), file, digests[file])
 
+    return documents, timings
 
 
-def load_all_pdfs(folder):
-    chunks = []
-    chunk_roles = []
-    chunk_sources = []
-    chunk_pages = []   # ⭐ NEW
+def load_document(folder, file):
+    """Load a single PDF. Returns (document, timings)."""
+    documents, timings = load_documents(folder, [file])
+    return documents[file], timings
 
-    for file in os.listdir(folder):
-        if file.endswith(".pdf"):
-            path = os.path.join(folder, file)
 
-            extract_images_from_pdf(path, file)
+def load_corpus(folder):
+    """
+    Open the CURRENT corpus generation if it was built from exactly the PDFs
+    in the folder. Otherwise load every PDF, reusing the on-disk chunks and
+    embeddings of documents whose content hash is unchanged, and publish a new
+    generation. Only new or modified PDFs are parsed and embedded.
 
-            role = file.split("_")[0].upper()
+    With several workers starting at once, the first builds the generation
+    and the rest wait for it and open the same files.
 
-            reader = PdfReader(path)
+    Returns:
+        Corpus snapshot with memory-mapped per-role indexes
+    """
+    files = sorted(file for file in os.listdir(folder) if file.endswith(".pdf"))
+    digests = {file: file_digest(os.path.join(folder, file)) for file in files}
+    key = corpus_key(digests, index_variant())
 
-            for page_num, page in enumerate(reader.pages):
-                content = page.extract_text()
+    with generation_lock():
+        current = read_current_generation()
+        if current is not None and current["key"] == key:
+            try:
+                return Corpus.open(current["generation"])
+            except (OSError, ValueError, RuntimeError) as e:
+                print(f"Rebuilding unreadable corpus generation {current['generation']}: {e}")
 
-                if not content:
-                    continue
+        documents, _ = load_documents(folder, files, digests)
 
-                parts = split_text(content)
+        prune_cached_documents({d["digest"] for d in documents.values()})
+        prune_extracted_images(documents)
 
-                for part in parts:
-                    chunks.append(part)
-                    chunk_roles.append(role)
-                    chunk_sources.append(file)
-                    chunk_pages.append(page_num)   # ⭐ STORE PAGE
+        generation = Corpus.build(documents).save()
 
-    return chunks, chunk_roles, chunk_sources, chunk_pages
+    return Corpus.open(generation)
 
 
-def extract_images_from_pdf(pdf_path, pdf_name):
-    images = []
+# ----------- CREATE VECTOR INDEX -----------
+def embed_chunks(chunks):
+    # Unit length, so the inner-product indexes score by cosine similarity
+    return np.asarray(model.encode(chunks, normalize_embeddings=True), dtype="float32")
 
-    doc = fitz.open(pdf_path)
 
-    for page_index in range(len(doc)):
-        page = doc[page_index]
-        image_list = page.get_images(full=True)
+def count_tokens(text):
+    """Token count with the embedding model's tokenizer; also approximates prompt tokens."""
+    return len(model.tokenizer.tokenize(text))
 
-        for img_index, img in enumerate(image_list):
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            ext = base_image["ext"]
 
-            img_name = f"{pdf_name}_page{page_index}_{img_index}.{ext}"
-            img_path = os.path.join("extracted_images", img_name)
+# ----------- EMBEDDING SERVICE -----------
+EMBED_MAX_BATCH_SIZE = int(os.environ.get("RAG_EMBED_MAX_BATCH_SIZE", "64"))
+EMBED_MAX_WAIT_MS = float(os.environ.get("RAG_EMBED_MAX_WAIT_MS", "5"))
 
-            with open(img_path, "wb") as f:
-                f.write(image_bytes)
+QUERY_PRIORITY = 0
+INGEST_PRIORITY = 1
 
-            images.append(img_name)
 
-    return images
+class EmbeddingBatcher:
+    """
+    Runs every encode call on one worker thread, merging concurrent requests
+    into micro-batches of up to max_batch_size texts. Query encodes are
+    served before ingest encodes.
+
+    A request that finds the queue empty is encoded straight away, so a
+    single user pays no extra latency. Only when other requests are already
+    waiting does the worker hold a batch open for up to max_wait_ms to
+    collect stragglers.
+    """
 
+    def __init__(self, encode, max_batch_size=EMBED_MAX_BATCH_SIZE, max_wait_ms=EMBED_MAX_WAIT_MS):
+        self.encode_batch = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.metrics = {
+            "requests": 0,
+            "texts": 0,
+            "batches": 0,
+            "max_queue_depth": 0,
+            "encode_seconds": 0.0
+        }
 
+    def submit(self, texts, priority=QUERY_PRIORITY):
+        """Queue texts for encoding. Returns a Future resolving to a float32 matrix."""
+        future = Future()
 
-# ----------- SPLIT TEXT INTO CHUNKS -----------
-def split_text(text, chunk_size=400):
-    words = text.split()
-    chunks = []
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self.thread.start()
+            self.metrics["requests"] += 1
+            self.metrics["texts"] += len(texts)
 
-    for i in range(0, len(words), chunk_size):
-        chunks.append(" ".join(words[i:i+chunk_size]))
+        self.queue.put((priority, next(self.sequence), list(texts), future))
+        self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], self.queue.qsize())
 
-    return chunks
+        return future
 
+    def encode(self, texts, priority=INGEST_PRIORITY):
+        return self.submit(texts, priority).result()
 
+    def stats(self):
+        batches = self.metrics["batches"]
+        return {
+            **self.metrics,
+            "queue_depth": self.queue.qsize(),
+            "avg_batch_requests": round(self.metrics["requests"] / batches, 2) if batches else 0.0
+        }
 
-# ----------- CREATE VECTOR INDEX -----------
-def create_index(chunks):
-    embeddings = model.encode(chunks)
-    dimension = embeddings.shape[1]
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        size = len(batch[0][2])
+
+        # Only wait for stragglers when there is already concurrent demand
+        concurrent = not self.queue.empty()
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            try:
+                if concurrent:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if size + len(item[2]) > self.max_batch_size:
+                self.queue.put(item)
+                break
+
+            batch.append(item)
+            size += len(item[2])
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for _, _, item_texts, _ in batch for text in item_texts]
+
+            try:
+                started = time.perf_counter()
+                vectors = self.encode_batch(texts)
+                self.metrics["encode_seconds"] += time.perf_counter() - started
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.metrics["batches"] += 1
+
+            offset = 0
+            for _, _, item_texts, future in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+
+embedder = EmbeddingBatcher(embed_chunks)
+
+
+def empty_embeddings():
+    return np.zeros((0, model.get_sentence_embedding_dimension()), dtype="float32")
+
+
+def create_index(chunks=None, embeddings=None):
+    if embeddings is None:
+        embeddings = embed_chunks(chunks)
 
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings))
+    # Flat, HNSW, IVF-Flat or IVF-PQ depending on RAG_INDEX_TYPE
+    return create_ann_index(embeddings)
 
-    return index
+
+# BM25 next to every FAISS index, fused with the vector ranking at query time
+HYBRID_SEARCH = os.environ.get("RAG_HYBRID_SEARCH", "1") == "1"
+
+# How deep each side of a hybrid search looks before fusion
+HYBRID_CANDIDATES = int(os.environ.get("RAG_HYBRID_CANDIDATES", "20"))
+
+
+def index_variant():
+    """How the published indexes are built, part of the corpus key."""
+    return index_signature() + (":bm25" if HYBRID_SEARCH else "")
+
+
+def create_lexical_index(chunks):
+    return LexicalIndex.build(chunks) if HYBRID_SEARCH else None
+
+
+def build_role_index(documents, index=None, lexical=None):
+    """
+    Build the searchable view of a role from its documents.
+
+    Returns:
+        dict with "index", "lexical", "chunks", "sources", "source_names", "pages", "page_spans"
+    """
+    role_index = {"chunks": [], "sources": [], "pages": [], "page_spans": []}
+    matrices = []
+
+    for document in documents:
+        role_index["chunks"].extend(document["chunks"])
+        role_index["sources"].extend([document["source"]] * len(document["chunks"]))
+        role_index["pages"].extend(document["pages"])
+        role_index["page_spans"].extend(document["page_spans"])
+        matrices.append(document["embeddings"])
+
+    if index is None:
+        index = create_index(embeddings=np.concatenate(matrices))
+
+    role_index["index"] = index
+    role_index["source_names"] = sorted({document["source"] for document in documents})
+    role_index["lexical"] = lexical if lexical is not None else create_lexical_index(role_index["chunks"])
+    return role_index
+
+
+def extend_role_index(role_index, document):
+    """Copy a role view and add only the new document's vectors to it."""
+    # Flat and HNSW only (see is_ivf_index). A serialized round trip rather than
+    # clone_index, so the copy owns its codes instead of viewing the mapped file.
+    index = apply_search_params(faiss.deserialize_index(faiss.serialize_index(role_index["index"])))
+    index.add(np.ascontiguousarray(document["embeddings"], dtype="float32"))
+
+    # The current view may be memory-mapped; the copy is plain lists until it is saved
+    chunks = list(role_index["chunks"]) + document["chunks"]
+
+    return {
+        "index": index,
+        # BM25 idf and length norms are corpus-wide, so the lexical side is rebuilt
+        "lexical": create_lexical_index(chunks),
+        "chunks": chunks,
+        "sources": list(role_index["sources"]) + [document["source"]] * len(document["chunks"]),
+        "source_names": sorted(set(role_index["source_names"]) | {document["source"]}),
+        "pages": [int(page) for page in role_index["pages"]] + document["pages"],
+        "page_spans": [tuple(int(p) for p in span) for span in role_index["page_spans"]] + document["page_spans"],
+    }
+
+
+def role_members(documents, role):
+    return [
+        d for d in documents.values()
+        if d["chunks"] and (d["role"] == role or role == "ADMIN")
+    ]
+
+
+def describe_document(document):
+    """The per-document metadata a generation manifest keeps."""
+    return {"digest": document["digest"], "role": document["role"], "chunk_count": len(document["chunks"])}
+
+
+def document_lookups(documents):
+    """(source, page) -> image names and rule number -> {(source, page)} for full documents."""
+    page_images = {}
+    rule_pages = {}
+
+    for source, document in documents.items():
+        for page_num, names in document["page_images"].items():
+            page_images[(source, page_num)] = names
+        for rule, pages in document["rule_pages"].items():
+            rule_pages.setdefault(rule, set()).update((source, p) for p in pages)
+
+    return page_images, rule_pages
+
+
+class Corpus:
+    """
+    Immutable snapshot of the indexed documents with one FAISS index per role,
+    plus an ADMIN index over every chunk.
+
+    Uploads never mutate a snapshot: they derive a new one, publish it as a new
+    on-disk generation and the caller swaps its reference, so an in-flight /ask
+    keeps searching the snapshot it started with and never sees a half-built
+    index. A snapshot opened from a generation keeps its chunks, sources and
+    indexes memory-mapped; its version is the generation number.
+    """
+
+    def __init__(self, documents, role_indexes, page_images, rule_pages, version=None):
+        self.documents = documents          # filename -> {"digest", "role", "chunk_count"}
+        self.role_indexes = role_indexes    # role -> {"index", "lexical", "chunks", "sources", "source_names", "pages", "page_spans"}
+        self.version = version              # generation number; None until saved and opened
+
+        # Lookups kept per snapshot so /ask never touches PDF text again
+        self.page_images = page_images      # (source, page) -> image names
+        self.rule_pages = rule_pages        # rule number -> {(source, page)}
+
+    def pages_for_rules(self, rules):
+        """All (source, page) locations that mention any of the given RULE numbers."""
+        locations = set()
+        for rule in rules:
+            locations |= self.rule_pages.get(rule, set())
+        return locations
+
+    @property
+    def key(self):
+        return corpus_key({name: d["digest"] for name, d in self.documents.items()}, index_variant())
+
+    @classmethod
+    def build(cls, documents):
+        """Build every role index in memory from full documents; save() publishes it."""
+        role_indexes = {}
+        for role in {d["role"] for d in documents.values()} | {"ADMIN"}:
+            members = role_members(documents, role)
+            if members:
+                role_indexes[role] = build_role_index(members)
+
+        page_images, rule_pages = document_lookups(documents)
+        described = {name: describe_document(d) for name, d in documents.items()}
+
+        return cls(described, role_indexes, page_images, rule_pages)
+
+    @classmethod
+    def open(cls, generation):
+        """Memory-map a published generation."""
+        stored = open_generation(generation)
+
+        role_indexes = {}
+        for role, view in stored["roles"].items():
+            role_indexes[role] = {
+                "index": apply_search_params(view["index"]),
+                "lexical": LexicalIndex.from_state(*view["lexical"]) if view["lexical"] else None,
+                "chunks": view["chunks"],
+                "sources": view["sources"],
+                "source_names": view["sources"].names,
+                "pages": view["page_spans"][:, 0],
+                "page_spans": view["page_spans"],
+                # Where the files live, so a later generation can reuse them unchanged
+                "stored": view["stored"],
+            }
+
+        return cls(stored["documents"], role_indexes, stored["page_images"], stored["rule_pages"], generation)
+
+    def save(self):
+        """Publish this snapshot as the CURRENT generation. Call under generation_lock()."""
+        role_views = {}
+        for role, view in self.role_indexes.items():
+            if view.get("stored") is not None:
+                # Opened from a generation and untouched since: link its files, never re-serialize
+                role_views[role] = {"stored": view["stored"]}
+                continue
+
+            role_views[role] = {
+                "index": view["index"],
+                "chunks": view["chunks"],
+                "sources": view["sources"],
+                "page_spans": view["page_spans"],
+                "lexical": view["lexical"].state() if view["lexical"] is not None else None,
+            }
+
+        return write_generation(self.key, self.documents, role_views, self.page_images, self.rule_pages)
+
+    def count_chunks(self):
+        return sum(d["chunk_count"] for d in self.documents.values())
+
+    def load_members(self, role, document):
+        """Full documents of a role, reading all but the new one back from the document store."""
+        members = {}
+
+        for name, described in self.documents.items():
+            if name == document["source"] or not described["chunk_count"]:
+                continue
+            if described["role"] != role and role != "ADMIN":
+                continue
+
+            stored = load_cached_document(described["digest"])
+            if stored is None:
+                raise RuntimeError(f"Document store entry for {name} is missing; restart to rebuild the corpus")
+            members[name] = {**stored, "source": name, "role": described["role"]}
+
+        members[document["source"]] = document
+        return role_members(members, role)
+
+    def with_document(self, document):
+        """
+        Return a new, unsaved snapshot with the document added, or replacing
+        the previous version of the same file. Roles the document does not
+        belong to keep their existing indexes.
+        """
+        source = document["source"]
+        replaced = source in self.documents
+
+        documents = dict(self.documents)
+        documents[source] = describe_document(document)
+
+        page_images = {location: names for location, names in self.page_images.items() if location[0] != source}
+        rule_pages = {rule: {location for location in locations if location[0] != source}
+                      for rule, locations in self.rule_pages.items()}
+        added_images, added_rules = document_lookups({source: document})
+        page_images.update(added_images)
+        for rule, locations in added_rules.items():
+            rule_pages.setdefault(rule, set()).update(locations)
+
+        role_indexes = dict(self.role_indexes)
+
+        for role in {document["role"], "ADMIN"}:
+            current = self.role_indexes.get(role)
+
+            if not replaced and current is not None and not is_ivf_index(current["index"]):
+                # Plain addition: only the new vectors are added to a copy
+                if document["chunks"]:
+                    role_indexes[role] = extend_role_index(current, document)
+                continue
+
+            # Replacement (old vectors must go) or a memory-mapped IVF index that
+            # cannot be cloned: rebuild from stored embeddings
+            members = self.load_members(role, document)
+            if members:
+                role_indexes[role] = build_role_index(members)
+            else:
+                role_indexes.pop(role, None)
+
+        return Corpus(documents, role_indexes, page_images, {r: l for r, l in rule_pages.items() if l})
 
 
 # ----------- ASK QUESTION -----------
-def ask_question(question, index, chunks, history=None, return_indices=False):
-    q_embedding = model.encode([question])
-    D, I = index.search(np.array(q_embedding), k=5)
+ANSWER_MODEL = "mistral"
 
-    context = ""
-    matched_indices = I[0].tolist()  # Convert to list for easier handling
-    for i in matched_indices:
-        context += chunks[i] + "\n"
-
-    history_text = ""
-    if history:
-        for q, a in history:
-            history_text += f"User: {q}\nAssistant: {a}\n"
-
-    response = ollama.chat(
-        model="mistral",
-        messages=[
-            {
-                "role": "system",
-                "content": """You are an enterprise assistant providing clear, well-structured information.
+SYSTEM_PROMPT = """You are an enterprise assistant providing clear, well-structured information.
 
 IMPORTANT: Format your responses with:
 - Clear headings (use ## or ###)
@@ -152,14 +516,243 @@ NO ASCII ART BOXES OR DIAGRAMS. Use clean text formatting only.
 
 If information is not in the context, say:
 'This information is not available in the document.'"""
-            },
-            {
-                "role": "user",
-                "content": f"""
-Previous Conversation:
-{history_text}
-
-Context from Document:
+
+
+def search_index(index, q_embedding, k=5):
+    """
+    Returns:
+        (chunk positions, cosine similarity scores), best match first
+    """
+    D, I = index.search(q_embedding, k=min(k, index.ntotal))
+
+    matches = [(i, score) for i, score in zip(I[0].tolist(), D[0].tolist()) if i >= 0]
+    return [i for i, _ in matches], [score for _, score in matches]
+
+
+def hybrid_search(index, lexical, question, q_embedding, k=5):
+    """
+    Vector search, fused by reciprocal rank with BM25 when the role view has a
+    lexical index.
+
+    Returns:
+        (chunk positions, scores) where each score is a dict with the cosine
+        "score" (None for chunks only BM25 found) and, for hybrid results,
+        "bm25" and "rrf"
+    """
+    if lexical is None:
+        matched_indices, scores = search_index(index, q_embedding, k)
+        return matched_indices, [{"score": score} for score in scores]
+
+    dense_ids, dense_scores = search_index(index, q_embedding, max(k, HYBRID_CANDIDATES))
+    lexical_ids, lexical_scores = lexical.search(question, max(k, HYBRID_CANDIDATES))
+
+    cosine = dict(zip(dense_ids, dense_scores))
+    bm25 = dict(zip(lexical_ids, lexical_scores))
+    fused = reciprocal_rank_fusion([dense_ids, lexical_ids])
+
+    matched_indices = list(fused)[:k]
+    return matched_indices, [
+        {"score": cosine.get(i), "bm25": bm25.get(i), "rrf": fused[i]}
+        for i in matched_indices
+    ]
+
+
+# ----------- RERANK -----------
+# Optional cross-encoder stage: retrieve RERANK_CANDIDATES cheaply, rescore them
+# against the question, then keep the best k that fit the context token budget.
+# Shorter prompts make generation faster. Off unless RAG_RERANK_MODEL is set,
+# e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2".
+RERANK_MODEL = os.environ.get("RAG_RERANK_MODEL", "")
+RERANK_CANDIDATES = int(os.environ.get("RAG_RERANK_CANDIDATES", "20"))
+RERANK_BATCH_SIZE = int(os.environ.get("RAG_RERANK_BATCH_SIZE", "16"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKEN_BUDGET", "2000"))
+
+reranker = CrossEncoder(RERANK_MODEL) if RERANK_MODEL else None
+
+
+def rerank(question, chunks, candidate_ids, scores, k=5, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Rescore candidates with the cross-encoder and keep the best k within the token budget.
+    The best candidate is always kept, even if it alone exceeds the budget.
+
+    Returns:
+        (chunk positions, scores with an added "rerank" entry), best first
+    """
+    if not candidate_ids:
+        return [], []
+
+    rerank_scores = reranker.predict(
+        [(question, chunks[i]) for i in candidate_ids],
+        batch_size=RERANK_BATCH_SIZE
+    ).tolist()
+
+    ranked = sorted(zip(candidate_ids, scores, rerank_scores), key=lambda item: -item[2])
+
+    kept_ids, kept_scores = [], []
+    used_tokens = 0
+
+    for chunk_id, score, rerank_score in ranked:
+        tokens = count_tokens(chunks[chunk_id])
+        if kept_ids and used_tokens + tokens > token_budget:
+            continue
+        kept_ids.append(chunk_id)
+        kept_scores.append({**score, "rerank": rerank_score})
+        used_tokens += tokens
+        if len(kept_ids) == k:
+            break
+
+    return kept_ids, kept_scores
+
+
+def retrieve(question, index, k=5, lexical=None):
+    """Return the positions of the k chunks closest to the question."""
+    matched_indices, _ = hybrid_search(index, lexical, question, embed_chunks([question]), k)
+    return matched_indices
+
+
+async def retrieve_async(question, index, k=5, lexical=None, chunks=None):
+    """
+    retrieve() for the request path: the question joins the shared embedding micro-batches.
+    With a reranker configured and the role's chunks given, the top RERANK_CANDIDATES
+    are reranked down to k.
+
+    Returns:
+        (matched chunk positions, scores, question embedding, timings in ms)
+    """
+    use_reranker = reranker is not None and chunks is not None
+    started = time.perf_counter()
+
+    q_embedding = await asyncio.wrap_future(embedder.submit([question]))
+    matched_indices, scores = await asyncio.to_thread(
+        hybrid_search, index, lexical, question, q_embedding, max(k, RERANK_CANDIDATES) if use_reranker else k
+    )
+
+    timings = {"retrieve_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    if use_reranker:
+        started = time.perf_counter()
+        matched_indices, scores = await asyncio.to_thread(rerank, question, chunks, matched_indices, scores, k)
+        timings["rerank_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    return matched_indices, scores, q_embedding, timings
+
+
+# ----------- PROMPT ASSEMBLY -----------
+# Prefill of a long prompt is a large share of answer latency on CPU, so the
+# prompt is assembled within token budgets instead of concatenating everything.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("RAG_HISTORY_TOKEN_BUDGET", "400"))
+HISTORY_ANSWER_TOKENS = int(os.environ.get("RAG_HISTORY_ANSWER_TOKENS", "120"))
+
+# A chunk whose 8-word shingles are mostly already in the prompt adds nothing
+DUPLICATE_OVERLAP = 0.8
+SHINGLE_SIZE = 8
+
+
+def truncate_to_tokens(text, max_tokens):
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+
+    words = text.split()
+    keep = max(1, len(words) * max_tokens // tokens)
+    return " ".join(words[:keep]) + " ..."
+
+
+def _shingles(text):
+    words = text.lower().split()
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(max(1, len(words) - SHINGLE_SIZE + 1))}
+
+
+def select_context(context_chunks, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Drop chunks that duplicate or mostly overlap earlier (better ranked) ones,
+    then keep chunks in rank order while they fit the budget.
+
+    Returns:
+        (chunks, token count)
+    """
+    kept = []
+    seen = set()
+    used = 0
+
+    for chunk in context_chunks:
+        shingles = _shingles(chunk)
+        if len(shingles & seen) >= DUPLICATE_OVERLAP * len(shingles):
+            continue
+
+        tokens = count_tokens(chunk)
+        if used + tokens > token_budget:
+            if kept:
+                continue
+            # The best chunk alone is over budget: keep its beginning
+            chunk = truncate_to_tokens(chunk, token_budget)
+            tokens = count_tokens(chunk)
+
+        kept.append(chunk)
+        seen |= shingles
+        used += tokens
+
+    return kept, used
+
+
+def select_history(history, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    Keep the most recent turns that fit the budget, with long answers trimmed.
+
+    Returns:
+        (turns oldest to newest, token count)
+    """
+    turns = []
+    used = 0
+
+    for q, a in reversed(history or []):
+        a = truncate_to_tokens(a, HISTORY_ANSWER_TOKENS)
+        tokens = count_tokens(q) + count_tokens(a)
+        if used + tokens > token_budget:
+            break
+        turns.append((q, a))
+        used += tokens
+
+    return turns[::-1], used
+
+
+def history_digest(history):
+    """Digest of the turns select_history puts in the prompt, part of the answer cache key."""
+    turns, _ = select_history(history)
+    if not turns:
+        return ""
+    return hashlib.sha1(json.dumps(turns).encode("utf-8")).hexdigest()
+
+
+def build_messages(question, context_chunks, history=None):
+    """
+    Build the chat messages for the answer model.
+
+    The system prompt comes first and never changes, and past turns follow as
+    real chat messages, so Ollama can reuse its KV cache for that prefix across
+    requests. Only the last message carries this request's context.
+    """
+    context_chunks, context_tokens = select_context(context_chunks)
+    turns, history_tokens = select_history(history)
+
+    messages = [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        }
+    ]
+
+    for q, a in turns:
+        messages.append({"role": "user", "content": q})
+        messages.append({"role": "assistant", "content": a})
+
+    context = ""
+    for chunk in context_chunks:
+        context += chunk + "\n"
+
+    messages.append({
+        "role": "user",
+        "content": f"""Context from Document:
 {context}
 
 Question:
@@ -167,10 +760,23 @@ Question:
 
 Please provide a clear, well-structured answer using markdown formatting.
 """
-            }
-        ]
+    })
+
+    question_tokens = count_tokens(question)
+    print(
+        f"Prompt tokens: system={count_tokens(SYSTEM_PROMPT)} history={history_tokens} ({len(turns)} turns) "
+        f"context={context_tokens} ({len(context_chunks)} chunks) question={question_tokens}"
     )
 
+    return messages
+
+
+def ask_question(question, index, chunks, history=None, return_indices=False):
+    matched_indices = retrieve(question, index)
+    messages = build_messages(question, [chunks[i] for i in matched_indices], history)
+
+    response = ollama.chat(model=ANSWER_MODEL, messages=messages)
+
     answer = response['message']['content']
     
     if return_indices:
@@ -178,8 +784,201 @@ Please provide a clear, well-structured answer using markdown formatting.
     return answer
 
 
+answer_client = ollama.AsyncClient()
+
+
+async def ask_question_async(question, index, chunks, history=None, cache_scope=None, lexical=None):
+    """
+    Async ask_question for the request path.
+
+    Args:
+        cache_scope: optional (role, corpus version); when given, near-duplicate
+            questions that retrieve the same chunks reuse a cached answer
+        lexical: optional BM25 index of the same role view for hybrid retrieval
+
+    Returns:
+        (answer, matched indices, scores, timings in ms)
+    """
+    matched_indices, scores, q_embedding, timings = await retrieve_async(
+        question, index, lexical=lexical, chunks=chunks
+    )
+
+    if cache_scope:
+        digest = history_digest(history)
+        cached = get_cached_answer(*cache_scope, matched_indices, q_embedding, digest)
+        if cached is not None:
+            return cached, matched_indices, scores, timings
+
+    messages = build_messages(question, [chunks[i] for i in matched_indices], history)
+
+    started = time.perf_counter()
+    response = await answer_client.chat(model=ANSWER_MODEL, messages=messages)
+    answer = response['message']['content']
+    timings["generate_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    if cache_scope:
+        put_cached_answer(*cache_scope, matched_indices, q_embedding, answer, digest)
+
+    return answer, matched_indices, scores, timings
+
+
+async def stream_answer(messages):
+    """Yield answer tokens as the model generates them."""
+    async for part in await answer_client.chat(model=ANSWER_MODEL, messages=messages, stream=True):
+        content = part['message']['content']
+        if content:
+            yield content
+
+
 # ----------- INTERPRET IMAGES WITH VISION MODEL -----------
-def interpret_image_with_vision(image_path, question):
+VISION_MODEL = os.environ.get("RAG_VISION_MODEL", "llava")
+
+# Bounded fan-out against the local Ollama server, shared by all requests
+VISION_CONCURRENCY = int(os.environ.get("RAG_VISION_CONCURRENCY", "2"))
+# Per-image HTTP timeout, and how long one /ask waits before returning partial results
+VISION_TIMEOUT = float(os.environ.get("RAG_VISION_TIMEOUT", "180"))
+VISION_DEADLINE = float(os.environ.get("RAG_VISION_DEADLINE", "90"))
+
+# Async clients so a slow generation only holds a coroutine, never a server thread
+vision_client = ollama.AsyncClient(timeout=VISION_TIMEOUT)
+vision_semaphore = asyncio.Semaphore(VISION_CONCURRENCY)
+
+# Calls that outlive their request (see interpret_images) must stay referenced
+_background_tasks = set()
+
+# Tasks holding a vision_semaphore slot (or caching its answer). Only these
+# are left to finish when their request stops waiting; queued ones are cancelled.
+_vision_calls = set()
+
+# "question": per-question interpretation of each related image (cached per question)
+# "base": reuse one question-independent description per image (see describe_image)
+IMAGE_DETAIL_MODE = os.environ.get("RAG_IMAGE_DETAIL_MODE", "question")
+
+BASE_DESCRIPTION_PROMPT = """Describe this diagram/technical image in detail.
+
+Format your response with clear structure:
+
+## Overview
+What does this diagram show?
+
+## Key Components
+- List each important component or element visible in the image
+- Describe their function or purpose
+
+## Relevant Details
+- Important specifications or labels visible
+- Any measurements or values
+
+Use bullet points and short paragraphs. NO ASCII ART."""
+
+
+def read_image_bytes(image_path):
+    with open(image_path, "rb") as img_file:
+        return img_file.read()
+
+
+async def vision_chat(image_bytes, prompt_class, prompt):
+    """
+    Ask the vision model about an image, going through the persistent cache.
+    Only successful answers are cached, so a failed call is retried next time.
+    At most VISION_CONCURRENCY calls run against Ollama at once.
+    """
+    image_hash = hashlib.sha1(image_bytes).hexdigest()
+
+    cached = await asyncio.to_thread(get_cached_response, image_hash, VISION_MODEL, prompt_class)
+    if cached is not None:
+        return cached
+
+    task = asyncio.current_task()
+    try:
+        async with vision_semaphore:
+            _vision_calls.add(task)
+            response = await vision_client.chat(
+                model=VISION_MODEL,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                        "images": [base64.b64encode(image_bytes).decode('utf-8')]
+                    }
+                ]
+            )
+
+        content = response['message']['content']
+        await asyncio.to_thread(put_cached_response, image_hash, VISION_MODEL, prompt_class, content)
+    finally:
+        _vision_calls.discard(task)
+
+    return content
+
+
+async def describe_image(image_path):
+    """Question-independent description of an image, computed once and reused."""
+    try:
+        image_bytes = await asyncio.to_thread(read_image_bytes, image_path)
+
+        return await vision_chat(image_bytes, "base", BASE_DESCRIPTION_PROMPT)
+    except Exception as e:
+        print(f"Error describing image {image_path}: {e}")
+        return f"Could not interpret image. Error: {str(e)}"
+
+
+async def interpret_images(image_names, question, deadline=VISION_DEADLINE):
+    """
+    Interpret several images concurrently (at most VISION_CONCURRENCY at a time
+    across the whole server) and wait no longer than the deadline.
+
+    Images that are not done by then are returned with status "pending". Calls
+    already running against Ollama finish in the background and land in the
+    vision cache, so a repeated question picks them up; calls still queued for
+    a slot are cancelled so they do not delay later requests.
+
+    Returns:
+        list of {"image", "interpretation", "status"} in input order
+    """
+    tasks = {}
+
+    for name in image_names:
+        image_path = os.path.join(IMAGE_DIR, name)
+        if not os.path.exists(image_path):
+            continue
+        print(f"Interpreting image: {name}")
+        if IMAGE_DETAIL_MODE == "base":
+            task = asyncio.ensure_future(describe_image(image_path))
+        else:
+            task = asyncio.ensure_future(interpret_image_with_vision(image_path, question))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        tasks[name] = task
+
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=deadline)
+
+    for task in tasks.values():
+        if not task.done() and task not in _vision_calls:
+            task.cancel()
+
+    results = []
+    for name, task in tasks.items():
+        if task.done() and not task.cancelled():
+            results.append({"image": name, "interpretation": task.result(), "status": "done"})
+        else:
+            results.append({
+                "image": name,
+                "interpretation": "Image analysis is still running. Ask again shortly to see it.",
+                "status": "pending"
+            })
+
+    return results
+
+
+async def precompute_image_descriptions(image_names):
+    """Warm the base-description cache one image at a time, e.g. as a background task after ingest."""
+    for name in image_names:
+        await describe_image(os.path.join(IMAGE_DIR, name))
+
+
+async def interpret_image_with_vision(image_path, question):
     """
     Use LLaVA vision model to interpret and describe what the image shows.
     
@@ -191,15 +990,12 @@ def interpret_image_with_vision(image_path, question):
         A text description of what the image shows
     """
     try:
-        with open(image_path, "rb") as img_file:
-            image_data = base64.b64encode(img_file.read()).decode('utf-8')
+        image_bytes = await asyncio.to_thread(read_image_bytes, image_path)
         
-        response = ollama.chat(
-            model="llava",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Please analyze this diagram/technical image in detail.
+        return await vision_chat(
+            image_bytes,
+            f"interpret:{normalize_prompt(question)}",
+            f"""Please analyze this diagram/technical image in detail.
 
 User's Question: {question}
 
@@ -223,19 +1019,14 @@ How does this diagram relate to the user's question?
 ## Recommendations
 Any important notes or recommendations based on the diagram.
 
-Use bullet points and short paragraphs. NO ASCII ART.""",
-                    "images": [image_data]
-                }
-            ]
+Use bullet points and short paragraphs. NO ASCII ART."""
         )
-        
-        return response['message']['content']
     except Exception as e:
         print(f"Error interpreting image {image_path}: {e}")
         return f"Could not interpret image. Error: {str(e)}"
 
 
-def highlight_diagram_elements(image_path, question):
+async def highlight_diagram_elements(image_path, question):
     """
     Use LLaVA to identify key elements in the diagram, then highlight them.
     Works best with technical diagrams, blueprints, and schematics.
@@ -248,16 +1039,13 @@ def highlight_diagram_elements(image_path, question):
         dict with interpretation and base64 encoded highlighted image
     """
     try:
-        with open(image_path, "rb") as img_file:
-            image_data = base64.b64encode(img_file.read()).decode('utf-8')
+        image_bytes = await asyncio.to_thread(read_image_bytes, image_path)
         
         # Ask LLaVA to identify specific components
-        response = ollama.chat(
-            model="llava",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Analyze this technical diagram carefully.
+        interpretation = await vision_chat(
+            image_bytes,
+            f"highlight:{normalize_prompt(question)}",
+            f"""Analyze this technical diagram carefully.
 
 User's Question: {question}
 
@@ -278,63 +1066,11 @@ Describe any connections or relationships between components.
 ## Key Takeaways
 Summarize the most important information from the diagram relevant to the question.
 
-Use bullet points and clear headings. NO ASCII ART OR BOXES.""",
-                    "images": [image_data]
-                }
-            ]
-        )
-        
-        interpretation = response['message']['content']
-        
-        # Load the original image for annotation
-        img = Image.open(image_path)
-        img_width, img_height = img.size
-        
-        # Create a copy for highlighting
-        highlighted = img.copy()
-        draw = ImageDraw.Draw(highlighted, 'RGBA')
-        
-        # Add semi-transparent overlay to highlight areas
-        # This creates a "brightening" effect for attention regions
-        overlay = Image.new('RGBA', highlighted.size, (255, 255, 255, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
-        
-        # Add decorative borders and annotations
-        border_color = (255, 0, 0, 180)  # Red with transparency
-        
-        # Add a prominent border
-        border_width = 5
-        draw.rectangle(
-            [(border_width, border_width), 
-             (img_width - border_width, img_height - border_width)],
-            outline=border_color,
-            width=border_width
+Use bullet points and clear headings. NO ASCII ART OR BOXES."""
         )
         
-        # Add text label for analysis
-        try:
-            font = ImageFont.load_default()
-            label_text = "[AI Analyzed Diagram]"
-            draw.text((10, 10), label_text, fill=(255, 0, 0, 255), font=font)
-        except:
-            pass  # If font fails, just skip text
-        
-        # Convert to base64 for frontend display
-        buffered = BytesIO()
-        highlighted.save(buffered, format="PNG")
-        highlighted_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return {
-            "status": "success",
-            "interpretation": interpretation,
-            "original_image": image_path,
-            "highlighted_image": f"data:image/png;base64,{highlighted_base64}",
-            "analysis_info": {
-                "model_used": "llava",
-                "image_size": f"{img_width}x{img_height}",
-                "annotation_applied": True
-            }
-        }
+        # Annotating is CPU work, keep it off the event loop
+        return await asyncio.to_thread(render_highlighted_diagram, image_path, interpretation)
     
     except Exception as e:
         print(f"Error highlighting diagram {image_path}: {e}")
@@ -344,7 +1080,60 @@ Use bullet points and clear headings. NO ASCII ART OR BOXES.""",
         }
 
 
-def analyze_blueprint_component(image_path, component_name):
+def render_highlighted_diagram(image_path, interpretation):
+    """Draw the analysis border/label on the diagram and package the result."""
+    # Load the original image for annotation
+    img = Image.open(image_path)
+    img_width, img_height = img.size
+    
+    # Create a copy for highlighting
+    highlighted = img.copy()
+    draw = ImageDraw.Draw(highlighted, 'RGBA')
+    
+    # Add semi-transparent overlay to highlight areas
+    # This creates a "brightening" effect for attention regions
+    overlay = Image.new('RGBA', highlighted.size, (255, 255, 255, 0))
+    overlay_draw = ImageDraw.Draw(overlay)
+    
+    # Add decorative borders and annotations
+    border_color = (255, 0, 0, 180)  # Red with transparency
+    
+    # Add a prominent border
+    border_width = 5
+    draw.rectangle(
+        [(border_width, border_width), 
+         (img_width - border_width, img_height - border_width)],
+        outline=border_color,
+        width=border_width
+    )
+    
+    # Add text label for analysis
+    try:
+        font = ImageFont.load_default()
+        label_text = "[AI Analyzed Diagram]"
+        draw.text((10, 10), label_text, fill=(255, 0, 0, 255), font=font)
+    except:
+        pass  # If font fails, just skip text
+    
+    # Convert to base64 for frontend display
+    buffered = BytesIO()
+    highlighted.save(buffered, format="PNG")
+    highlighted_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    
+    return {
+        "status": "success",
+        "interpretation": interpretation,
+        "original_image": image_path,
+        "highlighted_image": f"data:image/png;base64,{highlighted_base64}",
+        "analysis_info": {
+            "model_used": VISION_MODEL,
+            "image_size": f"{img_width}x{img_height}",
+            "annotation_applied": True
+        }
+    }
+
+
+async def analyze_blueprint_component(image_path, component_name):
     """
     Deep analysis of a specific component in a blueprint/schematic.
     Useful for detailed technical queries.
@@ -357,15 +1146,12 @@ def analyze_blueprint_component(image_path, component_name):
         Detailed analysis of the component
     """
     try:
-        with open(image_path, "rb") as img_file:
-            image_data = base64.b64encode(img_file.read()).decode('utf-8')
+        image_bytes = await asyncio.to_thread(read_image_bytes, image_path)
         
-        response = ollama.chat(
-            model="llava",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Examine this diagram carefully and focus on the '{component_name}'.
+        return await vision_chat(
+            image_bytes,
+            f"component:{normalize_prompt(component_name)}",
+            f"""Examine this diagram carefully and focus on the '{component_name}'.
 
 Provide detailed analysis with these sections:
 
@@ -390,13 +1176,8 @@ Maintenance requirements, inspection points, or operational notes.
 ## Identification
 Any part numbers, labels, or codes visible on or near this component?
 
-Use clear formatting with bullet points. NO ASCII ART.""",
-                    "images": [image_data]
-                }
-            ]
+Use clear formatting with bullet points. NO ASCII ART."""
         )
-        
-        return response['message']['content']
     except Exception as e:
         print(f"Error analyzing component in image: {e}")
         return f"Could not analyze component. Error: {str(e)}"
@@ -410,7 +1191,7 @@ if __name__ == "__main__":
     text = load_pdf_text(pdf_path)
 
     print("Splitting text...")
-    chunks = split_text(text)
+    chunks = split_text(text, count_tokens)
 
     print("Creating FAISS index...")
     index = create_index(chunks)
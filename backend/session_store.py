@@ -0,0 +1,131 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Per-user list of the images shown most recently, so "analyze the above image"
+# follow-ups work. The SQLite backend is shared by every uvicorn worker on the
+# host; the memory backend is a single-process stand-in.
+SESSION_BACKEND = os.environ.get("RAG_SESSION_BACKEND", "sqlite").lower()
+SESSION_DB_PATH = os.environ.get("RAG_SESSION_DB", "sessions.db")
+SESSION_TTL = float(os.environ.get("RAG_SESSION_TTL", str(8 * 3600)))
+SESSION_MAX_USERS = int(os.environ.get("RAG_SESSION_MAX_USERS", "10000"))
+IMAGES_PER_USER = 5
+
+# Expired and over-bound sessions are swept every this many writes
+EVICT_EVERY = 100
+
+
+class MemorySessionStore:
+    """In-process LRU/TTL store; does not share sessions between workers."""
+
+    def __init__(self, ttl=SESSION_TTL, max_users=SESSION_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.sessions = OrderedDict()   # username -> (images, updated)
+        self.lock = threading.Lock()
+
+    def _current(self, username):
+        session = self.sessions.get(username)
+        if session is None:
+            return []
+        if session[1] < time.time() - self.ttl:
+            del self.sessions[username]
+            return []
+        return list(session[0])
+
+    def get_images(self, username):
+        with self.lock:
+            return self._current(username)
+
+    def store_images(self, username, images):
+        with self.lock:
+            previous = self._current(username)
+            self.sessions[username] = ((images + previous)[:IMAGES_PER_USER], time.time())
+            self.sessions.move_to_end(username)
+            while len(self.sessions) > self.max_users:
+                self.sessions.popitem(last=False)
+
+
+class SQLiteSessionStore:
+    """SQLite-backed LRU/TTL store, safe to share between worker processes."""
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL, max_users=SESSION_MAX_USERS):
+        self.path = path
+        self.ttl = ttl
+        self.max_users = max_users
+        self.local = threading.local()
+        self.writes = 0
+
+        conn = self._connection()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS image_sessions (
+                    username TEXT PRIMARY KEY,
+                    images TEXT,
+                    updated REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_image_sessions_updated ON image_sessions (updated)")
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+
+        if conn is None:
+            # Autocommit; transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+
+        return conn
+
+    def get_images(self, username):
+        row = self._connection().execute(
+            "SELECT images FROM image_sessions WHERE username=? AND updated>=?",
+            (username, time.time() - self.ttl)
+        ).fetchone()
+
+        return json.loads(row[0]) if row else []
+
+    def store_images(self, username, images):
+        conn = self._connection()
+        now = time.time()
+
+        # One write transaction, so concurrent workers cannot lose each other's images
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT images FROM image_sessions WHERE username=? AND updated>=?",
+                (username, now - self.ttl)
+            ).fetchone()
+            previous = json.loads(row[0]) if row else []
+
+            conn.execute(
+                "INSERT OR REPLACE INTO image_sessions (username, images, updated) VALUES (?, ?, ?)",
+                (username, json.dumps((images + previous)[:IMAGES_PER_USER]), now)
+            )
+
+            self.writes += 1
+            if self.writes % EVICT_EVERY == 0:
+                conn.execute("DELETE FROM image_sessions WHERE updated<?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM image_sessions WHERE rowid IN ("
+                    "SELECT rowid FROM image_sessions ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                    (self.max_users,)
+                )
+
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown session backend {backend!r}, expected 'sqlite' or 'memory'")
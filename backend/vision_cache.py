@@ -0,0 +1,85 @@
+import os
+import re
+import sqlite3
+import time
+
+from index_store import CACHE_DIR
+
+# Persistent cache of vision-model answers, keyed by image content hash, model
+# and a normalized prompt class. Vision calls on CPU take tens of seconds, so
+# the same diagram should only ever be described once per kind of question.
+VISION_CACHE_PATH = os.path.join(CACHE_DIR, "vision_cache.db")
+VISION_CACHE_MAX_ENTRIES = int(os.environ.get("RAG_VISION_CACHE_MAX_ENTRIES", "5000"))
+
+_initialized = False
+
+
+def _connect():
+    global _initialized
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(VISION_CACHE_PATH, timeout=30)
+
+    if not _initialized:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS vision_cache (
+                image_hash TEXT,
+                model TEXT,
+                prompt_class TEXT,
+                response TEXT,
+                last_used REAL,
+                PRIMARY KEY (image_hash, model, prompt_class)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_vision_cache_last_used ON vision_cache (last_used)")
+        conn.commit()
+        _initialized = True
+
+    return conn
+
+
+def normalize_prompt(text):
+    """Case, punctuation and spacing differences should not cause a miss."""
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+
+def get_cached_response(image_hash, model, prompt_class):
+    conn = _connect()
+
+    try:
+        row = conn.execute(
+            "SELECT response FROM vision_cache WHERE image_hash=? AND model=? AND prompt_class=?",
+            (image_hash, model, prompt_class)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        conn.execute(
+            "UPDATE vision_cache SET last_used=? WHERE image_hash=? AND model=? AND prompt_class=?",
+            (time.time(), image_hash, model, prompt_class)
+        )
+        conn.commit()
+        return row[0]
+    finally:
+        conn.close()
+
+
+def put_cached_response(image_hash, model, prompt_class, response):
+    """Store a response and evict the least recently used entries beyond the size bound."""
+    conn = _connect()
+
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO vision_cache (image_hash, model, prompt_class, response, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (image_hash, model, prompt_class, response, time.time())
+        )
+        conn.execute(
+            "DELETE FROM vision_cache WHERE rowid IN ("
+            "SELECT rowid FROM vision_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (VISION_CACHE_MAX_ENTRIES,)
+        )
+        conn.commit()
+    finally:
+        conn.close()